@@ -10,5 +10,10 @@ if time_until_warning >= time_until_expiration:
     raise Exception("LOCKING['time_until_warning'] must be smaller than"
                     "  LOCKING['time_until_expiration']"
                     )
+
+if settings.LOCKING.get('min_refresh_interval', 0) >= time_until_expiration:
+    raise Exception("LOCKING['min_refresh_interval'] must be smaller than"
+                    " LOCKING['time_until_expiration']"
+                    )
     
 logger = logging.getLogger('django.locker')
\ No newline at end of file
@@ -1,25 +1,74 @@
 # -*- coding: utf-8 -*-
 from django.conf import settings
 from django.conf.urls.defaults import patterns, url
+from django import forms
 from django.contrib import admin
-from django.contrib.admin.util import unquote, model_ngettext
+from django.contrib.admin.util import flatten_fieldsets, unquote, model_ngettext
+from django.contrib.auth import models as auth
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import PermissionDenied
+from django.core.urlresolvers import reverse, NoReverseMatch
 from django.http import HttpResponse
 from django.utils import formats, simplejson
+from django.utils.html import escape
 from django.utils.translation import ugettext_lazy, ugettext as _
 
-from locking.models import ObjectLockedError
+from locking import assets, inventory, queries
+from locking.models import Lock, ObjectLockedError
+from locking.utils import gather_lockable_models
+
+
+class LockStatusFilter(admin.SimpleListFilter):
+    """
+    Changelist filter on lock status, evaluated in SQL.
+    """
+    title = ugettext_lazy('lock')
+    parameter_name = 'lock'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('mine', ugettext_lazy('Locked by me')),
+            ('others', ugettext_lazy('Locked by others')),
+            ('free', ugettext_lazy('Not locked')),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value() in ('mine', 'others', 'free'):
+            return queries.filter_by_lock(queryset, self.value(), request.user)
+        return queryset
+
+
+def _all_fields(model_admin, readonly_fields):
+    """
+    Returns the names of all the fields ``model_admin`` displays, to render
+    them read-only, ``readonly_fields`` included.
+    """
+    readonly_fields = list(readonly_fields)
+    if model_admin.declared_fieldsets:
+        names = flatten_fieldsets(model_admin.declared_fieldsets)
+    else:
+        opts = model_admin.model._meta
+        parent_model = getattr(model_admin, 'parent_model', None)
+        names = [field.name for field in opts.fields + opts.many_to_many
+                 if field.editable and not field.auto_created
+                 # An inline's key to its parent isn't displayed
+                 and not (parent_model and field.rel and field.rel.to is parent_model)]
+    model_fields = set(field.name for field in model_admin.model._meta.fields
+                       + model_admin.model._meta.many_to_many)
+    # Fields that only exist on the form can't be displayed read-only
+    return [name for name in names if name in readonly_fields or name in model_fields
+            or hasattr(model_admin, name) or hasattr(model_admin.model, name)] \
+        + [name for name in readonly_fields if name not in names]
 
 
 class LockableAdmin(admin.ModelAdmin):
-    class Media():
-        css = {
-               'all': ('locking/css/locking.css',)
-            }
-        js = (
-              'locking/js/admin.locking.js',
-              'locking/js/jquery.url.packed.js',
-             )
+    @property
+    def media(self):
+        # The locking scripts and translations, as one cacheable bundle
+        return super(LockableAdmin, self).media + forms.Media(
+            css={'all': ('locking/css/locking.css',)},
+            js=(assets.bundle_url(),),
+        )
 
     def force_unlock(self, request, queryset):
         """
@@ -53,8 +102,11 @@ class LockableAdmin(admin.ModelAdmin):
         # and we just ignore the request.
         # That way, any new lock that may since have been put in place by another
         # user won't get accidentally overwritten.
+        if obj.lock_field_groups:
+            obj.unlock_field_groups_for(request.user)
+            return HttpResponse(status=200)
         try:
-            obj.unlock_for(request.user)
+            obj.unlock_for(request.user, token=request.GET.get('token'))
             obj._is_a_locking_request = True
             return HttpResponse(status=200)
         except ObjectLockedError:
@@ -65,12 +117,25 @@ class LockableAdmin(admin.ModelAdmin):
 
         if not self.has_change_permission(request, obj):
             raise PermissionDenied
-        try:
-            obj.lock_for(request.user)
-        except ObjectLockedError:
-            # The user tried to overwrite an existing lock by another user.
-            # No can do, pal!
-            return HttpResponse(status=409)  # Conflict
+        field_group = request.GET.get('field_group')
+        if field_group:
+            return self.refresh_field_group_lock(request, obj, field_group)
+        if obj.lock_field_groups:
+            return self.refresh_field_groups_status(request, obj)
+
+        # A heartbeat from the window holding the lock only has to extend it,
+        # anything else is a new acquisition.
+        token = request.GET.get('token')
+        if not obj.refresh_lock(token):
+            try:
+                token = obj.lock_for(request.user, renew=True)
+            except ObjectLockedError:
+                # The user tried to overwrite an existing lock by another user.
+                # No can do, pal!
+                response = simplejson.dumps({
+                    'for_user': escape(obj.locked_by.get_full_name()),
+                })
+                return HttpResponse(response, status=409, mimetype="application/json")  # Conflict
 
         # Format date like a DateTimeInput would have done
         format = formats.get_format('DATETIME_INPUT_FORMATS')[0]
@@ -80,10 +145,91 @@ class LockableAdmin(admin.ModelAdmin):
         response = simplejson.dumps({
             'original_locked_at': original_locked_at,
             'original_modified_at': original_modified_at,
+            'lock_token': token,
         })
 
         return HttpResponse(response, mimetype="application/json")
 
+    def refresh_field_group_lock(self, request, obj, field_group):
+        if field_group not in obj.lock_field_groups:
+            return HttpResponse(status=400)
+        try:
+            token = obj.lock_field_group_for(request.user, field_group)
+        except ObjectLockedError:
+            return HttpResponse(status=409)  # Conflict
+        format = formats.get_format('DATETIME_INPUT_FORMATS')[0]
+        response = simplejson.dumps({
+            'original_modified_at': obj.modified_at.strftime(format),
+            'field_group': field_group,
+            'lock_token': token,
+        })
+        return HttpResponse(response, mimetype="application/json")
+
+    def refresh_field_groups_status(self, request, obj):
+        # Other users may hold some of the groups, which lock_for would take
+        # for a conflict: only extend the whole-object lock of this window,
+        # if any, and tell which groups are locked by somebody else
+        token = request.GET.get('token')
+        if not obj.refresh_lock(token):
+            token = ''
+        locks = obj.field_group_locks()
+        format = formats.get_format('DATETIME_INPUT_FORMATS')[0]
+        response = simplejson.dumps({
+            'original_locked_at': obj.locked_at and obj.locked_at.strftime(format) or '',
+            'original_modified_at': obj.modified_at.strftime(format),
+            'lock_token': token,
+            'locked_field_groups': sorted(group for group, info in locks.items()
+                                          if group and info.lock_applies_to(request.user)),
+        })
+        return HttpResponse(response, mimetype="application/json")
+
+    def is_read_only_when_locked(self, request):
+        """
+        When True, the change form of an object locked by somebody else is
+        rendered read-only: fields are displayed as text rather than
+        widgets, inlines can't be added to or deleted from, and the browser
+        doesn't have to disable the form. Set ``read_only_when_locked`` on
+        the admin, or ``LOCKING['read_only_when_locked']`` for all admins.
+        """
+        if self.read_only_when_locked is not None:
+            return self.read_only_when_locked
+        return settings.LOCKING.get('read_only_when_locked', False)
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        if request.method == 'GET' and self.is_read_only_when_locked(request):
+            if self.model.lock_parent:
+                obj = self.get_object(request, unquote(object_id))
+            else:
+                # The lock is found from the key alone
+                obj = self.model(pk=unquote(object_id))
+            # Not lock_applies_to, which logs the object: a stub may not be
+            # displayable. Kept for the locking_variables tag.
+            request._locking_applies = obj is not None and obj.is_locked \
+                and not obj.is_locked_by(request.user)
+            request._locking_read_only = request._locking_applies
+        return super(LockableAdmin, self).change_view(request, object_id, form_url,
+                                                      extra_context)
+
+    def get_readonly_fields(self, request, obj=None):
+        readonly_fields = super(LockableAdmin, self).get_readonly_fields(request, obj)
+        if getattr(request, '_locking_read_only', False):
+            return _all_fields(self, readonly_fields)
+        if obj is not None and obj.lock_field_groups:
+            # The groups of fields other users are editing
+            return list(readonly_fields) + [name for name in obj.fields_locked_for(request.user)
+                                            if name not in readonly_fields]
+        return readonly_fields
+
+    def get_inline_instances(self, request):
+        inline_instances = super(LockableAdmin, self).get_inline_instances(request)
+        if getattr(request, '_locking_read_only', False):
+            # Instances are created for each request
+            for inline in inline_instances:
+                inline.readonly_fields = _all_fields(inline, inline.get_readonly_fields(request))
+                inline.extra = inline.max_num = 0
+                inline.can_delete = False
+        return inline_instances
+
     def get_urls(self):
         """
         Override get_urls() to add a locking URLs.
@@ -109,10 +255,18 @@ class LockableAdmin(admin.ModelAdmin):
     def save_model(self, request, obj, form, change, *args, **kwargs):
         # object creation doesn't need/have locking in place
         if not form.is_locking_disabled() and obj.pk:
-            obj.unlock_for(request.user)
+            if obj.lock_field_groups:
+                obj.unlock_field_groups_for(request.user)
+            else:
+                obj.unlock_for(request.user, token=form.cleaned_data.get('lock_token'))
         super(LockableAdmin, self).save_model(request, obj, form, change, *args,
                                           **kwargs)
 
+    def queryset(self, request):
+        # Fetch lock status along with the objects, so the changelist doesn't
+        # need a query per row and can sort on lock age
+        return queries.with_lock_columns(super(LockableAdmin, self).queryset(request))
+
     def get_object(self, request, object_id):
         obj = super(LockableAdmin, self).get_object(request, object_id)
         if obj is not None:
@@ -122,20 +276,141 @@ class LockableAdmin(admin.ModelAdmin):
 
     def lock(self, obj):
         message = ''
-        if obj.is_locked:
-            seconds_remaining = obj.lock_seconds_remaining
+        lock = queries.lock_info(obj)
+        if lock.is_locked:
+            seconds_remaining = lock.lock_seconds_remaining
             minutes_remaining = seconds_remaining / 60
-            if self.request.user == obj.locked_by:
+            if lock.is_locked_by(self.request.user):
                 locked_until_self = _("You have a lock on this article for %s more minutes.") \
                     % (minutes_remaining)
                 message = '<img src="%slocking/img/page_edit.png" title="%s" />' \
                     % (settings.MEDIA_URL, locked_until_self)
             else:
                 locked_until = _("Still locked for %(minutes)s minutes by %(user)s") \
-                % {"minutes": minutes_remaining, "user": obj.locked_by}
+                % {"minutes": minutes_remaining, "user": lock.username}
                 message = '<img src="%slocking/img/lock.png" title="%s" />' \
                     % (settings.MEDIA_URL, locked_until)
 
         return message
     lock.allow_tags = True
+    lock.admin_order_field = 'lock_locked_at'
     list_display = ('__str__', 'lock')
+    list_filter = (LockStatusFilter,)
+    # Render the change forms of objects locked by somebody else read-only,
+    # see ``is_read_only_when_locked``. ``None`` defers to
+    # ``LOCKING['read_only_when_locked']``.
+    read_only_when_locked = None
+
+
+class LockableModelFilter(admin.SimpleListFilter):
+    title = ugettext_lazy('model')
+    parameter_name = 'model'
+
+    def lookups(self, request, model_admin):
+        return [(ContentType.objects.get_for_model(model).pk, model._meta.verbose_name)
+                for model in gather_lockable_models()]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(content_type=self.value())
+        return queryset
+
+
+class LockHolderFilter(admin.SimpleListFilter):
+    """
+    Changelist filter on the user holding the lock, among the users who hold
+    active locks rather than all users.
+    """
+    title = ugettext_lazy('locked by')
+    parameter_name = 'locked_by'
+
+    def lookups(self, request, model_admin):
+        # Locks may be on a database of their own, see ``locking.routers``
+        user_ids = set(Lock.objects.active().values_list('locked_by', flat=True))
+        return [(user.pk, user.username) for user
+                in auth.User.objects.filter(pk__in=user_ids).order_by('username')]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(locked_by=self.value())
+        return queryset
+
+
+class LockAdmin(admin.ModelAdmin):
+    """
+    Lists all active locks, across lockable models. Filter on ``locked_by`` to
+    see the locks held by a given user.
+
+    Locked objects are fetched with one query per model, rather than one per
+    lock.
+    """
+    list_display = ('locked_object', 'content_type', 'field_group', 'locked_by', 'locked_at',
+                    'expires_at', 'hard_lock')
+    list_filter = (LockableModelFilter, LockHolderFilter)
+    list_per_page = 500
+    readonly_fields = ('content_type', 'object_id')
+    actions = None
+
+    def queryset(self, request):
+        locks = super(LockAdmin, self).queryset(request)
+        return queries.filter_active_locks(locks) \
+            .select_related('locked_by') \
+            .prefetch_related('content_object')
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_urls(self):
+        urls = super(LockAdmin, self).get_urls()
+        info = self.model._meta.app_label, self.model._meta.module_name
+        return patterns('',
+            url(r'^export/$', self.admin_site.admin_view(self.export_view),
+                name='%s_%s_export' % info),
+        ) + urls
+
+    def changelist_view(self, request, extra_context=None):
+        # The export links carry the changelist's filters
+        context = {'export_query': request.GET.urlencode()}
+        context.update(extra_context or {})
+        return super(LockAdmin, self).changelist_view(request, context)
+
+    def export_view(self, request):
+        """
+        Streams the locks as JSON Lines (``format=jsonl``, the default) or
+        CSV (``format=csv``), see ``locking.inventory``. Takes the model and
+        user filters of the changelist, and ``state``.
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        format = request.GET.get('format', 'jsonl')
+        state = request.GET.get('state', 'active')
+        if format not in inventory.FORMATS or state not in inventory.STATES:
+            return HttpResponse(status=400)
+        filters = []
+        for name in ('model', 'locked_by'):
+            value = request.GET.get(name) or None
+            if value is not None and not value.isdigit():
+                return HttpResponse(status=400)
+            filters.append(value)
+        write, mimetype = inventory.FORMATS[format]
+        locks = inventory.lock_inventory(state, *filters)
+        # The response is written as the locks are read
+        response = HttpResponse(write(locks), mimetype=mimetype)
+        response['Content-Disposition'] = 'attachment; filename=locks.%s' % format
+        return response
+
+    def locked_object(self, lock):
+        obj = lock.content_object
+        if obj is None:
+            return ''
+        opts = obj._meta
+        try:
+            url = reverse('admin:%s_%s_change' % (opts.app_label, opts.module_name),
+                          args=[obj.pk], current_app=self.admin_site.name)
+        except NoReverseMatch:
+            return escape(obj)
+        return '<a href="%s">%s</a>' % (url, escape(obj))
+    locked_object.allow_tags = True
+    locked_object.short_description = ugettext_lazy('object')
+
+admin.site.register(Lock, LockAdmin)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+The client side of the locking admin as one script per language: the
+locking translations, ``jquery.url.packed.js`` and ``admin.locking.js``,
+minified.
+
+Bundles are built once per process and language, and served by
+``locking.views.bundle`` under a url that contains a hash of their content,
+so that browsers may cache them forever and change forms don't need a
+``jsi18n`` request for the locking translations.
+"""
+import gettext as gettext_module
+import hashlib
+import os
+import re
+import threading
+
+from django.core.urlresolvers import reverse
+from django.utils import simplejson
+from django.utils.translation import get_language, to_locale
+
+import locking
+
+SOURCES = (
+    'locking/js/jquery.url.packed.js',
+    'locking/js/admin.locking.js',
+)
+
+STATIC_ROOT = os.path.join(os.path.dirname(locking.__file__), 'static')
+LOCALE_ROOT = os.path.join(os.path.dirname(locking.__file__), 'locale')
+
+block_comment_re = re.compile(r'^\s*/\*.*?\*/[ \t]*$', re.M | re.S)
+line_comment_re = re.compile(r'^\s*//.*$', re.M)
+
+
+def minify(source):
+    """
+    Strips comments on lines of their own, indentation and blank lines,
+    which doesn't change the meaning of a script.
+    """
+    source = block_comment_re.sub('', source)
+    source = line_comment_re.sub('', source)
+    return '\n'.join(line.strip() for line in source.splitlines() if line.strip())
+
+
+def catalog(language):
+    """
+    Returns the translations of the locking scripts in ``language``, as a
+    dict, from the compiled ``djangojs`` catalog in ``locking/locale``.
+    """
+    try:
+        translation = gettext_module.translation('djangojs', LOCALE_ROOT, [to_locale(language)])
+    except IOError:
+        return {}
+    # Skip the catalog's metadata and plurals, the scripts only use gettext
+    return dict((msgid, msgstr) for msgid, msgstr in translation._catalog.items()
+                if msgid and isinstance(msgid, basestring))
+
+
+def build(language):
+    parts = ['var locking_catalog = %s;' % simplejson.dumps(catalog(language))]
+    for path in SOURCES:
+        source = open(os.path.join(STATIC_ROOT, path)).read().decode('utf-8')
+        parts.append(minify(source))
+    return '\n'.join(parts)
+
+
+class BundleCache(object):
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._bundles = {}
+
+    def get(self, language):
+        """
+        Returns the bundle for ``language`` and the hash of its content.
+        """
+        bundle = self._bundles.get(language)
+        if bundle is None:
+            script = build(language)
+            bundle = (script, hashlib.md5(script.encode('utf-8')).hexdigest()[:12])
+            self._mutex.acquire()
+            try:
+                bundle = self._bundles.setdefault(language, bundle)
+            finally:
+                self._mutex.release()
+        return bundle
+
+    def clear(self):
+        self._bundles.clear()
+
+bundles = BundleCache()
+
+
+def bundle_url(language=None):
+    """
+    Returns the url of the bundle for ``language``, the active language by
+    default.
+    """
+    language = language or get_language()
+    script, digest = bundles.get(language)
+    return reverse('locking_bundle', kwargs={'language': language, 'digest': digest})
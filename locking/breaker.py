@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+A circuit breaker that keeps a slow or failing lock store from stalling
+every change form.
+
+Enable it with ``LOCKING['budget']``, the number of seconds a lock read or
+write may take. Calls that take longer, or fail with a database error, count
+as failures; after ``LOCKING['breaker_threshold']`` of them in a row (5 by
+default) the breaker trips, and lock checks stop going to the database for
+``LOCKING['breaker_reset']`` seconds (30 by default). After that, one call
+is let through: if it's fast enough, the breaker recovers.
+
+While the breaker is open, lockable models fail open (objects look
+unlocked, locks aren't written) or, with ``lock_fail_open = False``, fail
+closed (objects look hard-locked). Hard locks always fail closed: they
+can't be taken, existing objects can't be saved since a hard lock may be
+in place, and lock refreshes fail. Trips and
+recoveries are logged and sent as the ``lock_store_tripped`` and
+``lock_store_recovered`` signals.
+
+Budgets aren't enforced by interrupting queries: slow calls still finish,
+but the following ones don't get to be slow.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+from locking import logger
+from locking import signals
+
+
+class Unavailable(Exception):
+    pass
+
+
+def is_enabled():
+    return settings.LOCKING.get('budget') is not None
+
+
+class CircuitBreaker(object):
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """
+        Returns whether a call may go to the lock store.
+        """
+        if self.opened_at is None:
+            return True
+        self._mutex.acquire()
+        try:
+            # Once the reset period has passed, let a single call through
+            reset = settings.LOCKING.get('breaker_reset', 30)
+            if not self._trial and time.time() - self.opened_at >= reset:
+                self._trial = True
+                return True
+            return False
+        finally:
+            self._mutex.release()
+
+    def record(self, elapsed, failed=False):
+        failed = failed or elapsed > settings.LOCKING['budget']
+        self._mutex.acquire()
+        try:
+            if not failed:
+                downtime = self.opened_at and time.time() - self.opened_at
+                self.reset()
+            elif self.opened_at is not None:
+                # The trial call failed, stay open for another period
+                self.opened_at = time.time()
+                self._trial = False
+                return
+            else:
+                downtime = None
+                self.failures += 1
+                if self.failures < settings.LOCKING.get('breaker_threshold', 5):
+                    return
+                self.opened_at = time.time()
+        finally:
+            self._mutex.release()
+        if failed:
+            logger.warning(u"Lock store tripped after %d slow or failed calls" % self.failures)
+            signals.lock_store_tripped.send(sender=self.__class__, failures=self.failures)
+        elif downtime:
+            logger.warning(u"Lock store recovered after %d seconds" % downtime)
+            signals.lock_store_recovered.send(sender=self.__class__, downtime=downtime)
+
+    def call(self, operation, using=None):
+        """
+        Runs ``operation``, a lock read or write on the database ``using``,
+        unless the breaker is open. Raises ``Unavailable`` when it is, or when
+        the operation fails.
+
+        Within a transaction, the operation runs in a savepoint, so that a
+        failure doesn't abort the rest of the transaction (as it would on
+        PostgreSQL).
+        """
+        if not is_enabled():
+            return operation()
+        if not self.allow():
+            raise Unavailable()
+        sid = None
+        if transaction.is_managed(using=using):
+            sid = transaction.savepoint(using=using)
+        start = time.time()
+        try:
+            result = operation()
+        except DatabaseError:
+            if sid is not None:
+                transaction.savepoint_rollback(sid, using=using)
+            self.record(time.time() - start, failed=True)
+            raise Unavailable()
+        if sid is not None:
+            transaction.savepoint_commit(sid, using=using)
+        self.record(time.time() - start)
+        return result
+
+circuit = CircuitBreaker()
+
+
+def call(operation, using=None):
+    return circuit.call(operation, using)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+The clock locks are dated and expired with, when they aren't dated with the
+database's (see ``locking.dbclock``).
+
+It's the web server's clock by default. Set ``LOCKING['clock']`` to the
+dotted path of another clock (an object, or a class, with a ``now`` method
+that returns a naive datetime), or ``install`` one, e.g. a ``ManualClock``
+in tests, benchmarks or simulations: moving it forward with ``advance``
+expires locks without waiting for them to.
+"""
+from datetime import datetime, timedelta
+import threading
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+
+class SystemClock(object):
+    def now(self):
+        return datetime.now()
+
+
+class ManualClock(object):
+    """
+    A clock that only moves when told to. Starts at ``start``, or at the
+    current time.
+    """
+    def __init__(self, start=None):
+        self._mutex = threading.Lock()
+        self.current = start or datetime.now()
+
+    def now(self):
+        return self.current
+
+    def advance(self, seconds):
+        self._mutex.acquire()
+        try:
+            self.current += timedelta(seconds=seconds)
+        finally:
+            self._mutex.release()
+
+    def set(self, moment):
+        self.current = moment
+
+system_clock = SystemClock()
+
+_installed = None
+_loaded = {}
+
+
+def _load(path):
+    if path not in _loaded:
+        module_name, name = path.rsplit('.', 1)
+        clock = getattr(import_module(module_name), name)
+        if isinstance(clock, type):
+            clock = clock()
+        _loaded[path] = clock
+    return _loaded[path]
+
+
+def get_clock():
+    """
+    Returns the clock in use: the installed one, the one of
+    ``LOCKING['clock']``, or the system clock.
+    """
+    if _installed is not None:
+        return _installed
+    path = settings.LOCKING.get('clock')
+    if path:
+        return _load(path)
+    return system_clock
+
+
+def install(clock):
+    """
+    Makes ``clock`` the clock in use, in all threads, and returns the one
+    that was installed before. ``install(None)`` goes back to
+    ``LOCKING['clock']`` or the system clock.
+    """
+    global _installed
+    previous, _installed = _installed, clock
+    return previous
+
+
+def now():
+    return get_clock().now()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Per-request accounting of the work done by the locking layer, reported by
+``locking.middleware.LockCostMiddleware``.
+
+Operations are counted per kind, with the time they took and the number of
+queries they ran:
+
+* ``contenttype``: resolving the content type of a lockable object
+* ``lock_read``: fetching locks
+* ``lock_write``: taking, refreshing and releasing locks
+* ``user_load``: loading the user who holds a lock
+
+Queries are counted on the connection locks are written to (see
+``locking.routers``), and on the default one.
+"""
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import time
+
+from django.db import connections, router
+from django.db.utils import DEFAULT_DB_ALIAS
+
+KINDS = ('contenttype', 'lock_read', 'lock_write', 'user_load')
+
+
+def counted_connections():
+    """
+    Returns the connections queries are counted on: the one of the database
+    alias locks are written to, and the default one, which content types and
+    users are read from.
+    """
+    # locking.models imports this module
+    from locking.models import Lock
+    aliases = [router.db_for_write(Lock)]
+    if DEFAULT_DB_ALIAS not in aliases:
+        aliases.append(DEFAULT_DB_ALIAS)
+    return [connections[alias] for alias in aliases]
+
+
+def _query_count():
+    return sum(len(connection.queries) for connection in counted_connections())
+
+
+class CostRecorder(threading.local):
+    def __init__(self):
+        self.totals = None
+        self._running = set()
+
+    @property
+    def is_active(self):
+        return self.totals is not None
+
+    def start(self):
+        self.totals = dict((kind, {'count': 0, 'queries': 0, 'time': 0.0}) for kind in KINDS)
+
+    def stop(self):
+        """
+        Stops recording, and returns the totals per kind of operation.
+        """
+        totals, self.totals = self.totals, None
+        return totals
+
+    @contextmanager
+    def measure(self, kind):
+        # Operations nested in one of the same kind (e.g. ``unlock`` called
+        # by ``unlock_for``) are part of it. Operations nested in one of
+        # another kind (e.g. a lock read during a lock write) count in both.
+        if self.totals is None or kind in self._running:
+            yield
+            return
+        self._running.add(kind)
+        queries = _query_count()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._running.discard(kind)
+            total = self.totals[kind]
+            total['count'] += 1
+            total['queries'] += _query_count() - queries
+            total['time'] += time.time() - start
+
+recorder = CostRecorder()
+measure = recorder.measure
+
+
+def measured(kind):
+    """
+    Decorator counting each call of the decorated function as an operation
+    of ``kind``.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(kind):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
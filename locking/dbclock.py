@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Lock expiry evaluated against the database's clock instead of the clock of
+each web server.
+
+Enable it with ``LOCKING['use_database_clock'] = True``. Locks are then dated
+with the database's current time, lock status is computed from the database's
+time when the lock is fetched, and the SQL helpers in ``locking.queries``
+compare lock dates with the database's time inside the query.
+
+Like the rest of django-locking, this assumes naive datetimes, in the time
+zone of the database connection.
+"""
+from django.conf import settings
+from django.db import connection
+from django.db.backends.util import typecast_timestamp
+
+
+def is_enabled():
+    return settings.LOCKING.get('use_database_clock', False)
+
+
+def now_sql():
+    """
+    Returns SQL for the database's current (local) time.
+    """
+    if connection.vendor == 'sqlite':
+        # Percent signs are doubled, the backend turns them back into one
+        return "strftime('%%Y-%%m-%%d %%H:%%M:%%f', 'now', 'localtime')"
+    elif connection.vendor == 'mysql':
+        return "NOW()"
+    return "LOCALTIMESTAMP"
+
+
+def from_now_sql(seconds):
+    """
+    Returns SQL for the database's current time, plus ``seconds`` (which may
+    be negative).
+    """
+    seconds = int(seconds)
+    if connection.vendor == 'sqlite':
+        return "strftime('%%Y-%%m-%%d %%H:%%M:%%f', 'now', 'localtime', '%+d seconds')" % seconds
+    elif connection.vendor == 'mysql':
+        return "(NOW() + INTERVAL %d SECOND)" % seconds
+    elif connection.vendor == 'oracle':
+        return "(LOCALTIMESTAMP + NUMTODSINTERVAL(%d, 'SECOND'))" % seconds
+    return "(LOCALTIMESTAMP + INTERVAL '%d seconds')" % seconds
+
+
+def ago_sql(seconds):
+    """
+    Returns SQL for the database's current time, minus ``seconds``.
+    """
+    return from_now_sql(-int(seconds))
+
+
+def parse(value):
+    # Some backends don't convert computed columns
+    if isinstance(value, basestring):
+        return typecast_timestamp(value)
+    return value
+
+
+def now():
+    """
+    Returns the database's current time.
+    """
+    sql = "SELECT %s" % now_sql()
+    if connection.vendor == 'oracle':
+        sql += " FROM DUAL"
+    cursor = connection.cursor()
+    cursor.execute(sql, ())
+    return parse(cursor.fetchone()[0])
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
 from django import forms
+from django.conf import settings
 from django.forms.util import ErrorList
 
 
 class LockableForm(forms.ModelForm):
     original_locked_at = forms.DateTimeField(required=False)
     original_modified_at = forms.DateTimeField(required=False)
+    lock_token = forms.CharField(required=False, widget=forms.HiddenInput)
 
     def __init__(self, data=None, files=None, auto_id='id_%s', prefix=None,
                  initial=None, error_class=ErrorList, label_suffix=':',
@@ -18,8 +20,20 @@ class LockableForm(forms.ModelForm):
             # Only try to lock if we are handling an existing object and we
             # are displaying a change-form (i.e., no POST data is given)
             obj = self.instance
-            if not obj.is_locked:
-                obj.lock_for(obj._request_user)
+            if not obj.is_locked and self.is_lazy_acquire():
+                # Don't lock yet, the client will ask for the lock as soon as
+                # the user starts editing
+                self.fields['original_modified_at'].initial = obj.modified_at
+            elif not obj.is_locked and obj.lock_field_groups:
+                # Lock the groups of fields nobody else is working on
+                self.fields['original_modified_at'].initial = obj.modified_at
+                locks = obj.field_group_locks()
+                for group in obj.lock_field_groups:
+                    if group not in locks or not locks[group].lock_applies_to(obj._request_user):
+                        obj.lock_field_group_for(obj._request_user, group)
+                obj._is_a_locking_request = True
+            elif not obj.is_locked:
+                self.fields['lock_token'].initial = obj.lock_for(obj._request_user)
                 obj._is_a_locking_request = True
                 self.fields['original_locked_at'].initial = obj.locked_at
                 self.fields['original_modified_at'].initial = obj.modified_at
@@ -27,6 +41,13 @@ class LockableForm(forms.ModelForm):
                 # obj is already locked by user, do not refresh lock, user
                 # will be warned that he is probably editing something twice
                 obj._was_already_locked_by_user = True
+        if self.instance.pk is not None and getattr(self.instance, 'lock_field_groups', None) \
+                and hasattr(self.instance, '_request_user'):
+            # The fields of the groups other users hold aren't edited, nor
+            # saved, by this form
+            self._locked_fields = self.instance.fields_locked_for(self.instance._request_user)
+            for name in self._locked_fields:
+                self.fields.pop(name, None)
 
     def is_locking_disabled(self):
         """
@@ -35,6 +56,31 @@ class LockableForm(forms.ModelForm):
         """
         return getattr(self, 'disable_locking', False)
 
+    def is_lazy_acquire(self):
+        """
+        When True, displaying the change form doesn't lock the object: the
+        lock is only taken once the user starts editing. Set ``lazy_acquire``
+        on the form, or ``LOCKING['lazy_acquire']`` for all forms.
+        """
+        return getattr(self, 'lazy_acquire', settings.LOCKING.get('lazy_acquire', False))
+
+    def field_group_infos(self):
+        """
+        For models with ``lock_field_groups``, returns the group of each field
+        and the fields that are locked by somebody else, for the client.
+        """
+        obj = self.instance
+        if obj.pk is None or not getattr(obj, 'lock_field_groups', None):
+            return None
+        field_groups = {}
+        for group, fields in obj.lock_field_groups.items():
+            for field in fields:
+                field_groups[field] = group
+        locks = obj.field_group_locks()
+        locked_fields = [field for field, group in field_groups.items()
+                         if group in locks and locks[group].lock_applies_to(obj._request_user)]
+        return {'field_groups': field_groups, 'locked_fields': locked_fields}
+
     def clean(self):
         """
         Before actually saving an existing model, check that model was actually
@@ -48,15 +94,23 @@ class LockableForm(forms.ModelForm):
             return cleaned_data
 
         obj = self.instance
+        if obj.pk is not None and obj._lock_unavailable():
+            # The lock store is down, somebody may hold a hard lock
+            self._locking_error_when_saving = 'lock_store_unavailable'
+            raise forms.ValidationError('Locking problem ! (Lock store unavailable)')
+        if obj.pk is not None and obj.lock_field_groups:
+            return self._clean_field_groups(cleaned_data)
+
         original_modified_at = cleaned_data['original_modified_at']
         original_locked_at = cleaned_data['original_locked_at']
+        lock_token = cleaned_data.get('lock_token')
         if obj.pk is not None:
             if not obj.is_locked:
                 if original_modified_at == obj.modified_at.replace(microsecond=0):
                     # obj was surprisingly not locked by user, but since it has
                     # not been modified, don't warn user, just lock and pretend
                     # everything is ok
-                    obj.lock_for(obj._request_user)
+                    cleaned_data['lock_token'] = obj.lock_for(obj._request_user)
                 else:
                     self._locking_error_when_saving = 'not_locked_and_modified'
                     raise forms.ValidationError('Locking problem ! (Not locked, was modified since)')
@@ -64,9 +118,52 @@ class LockableForm(forms.ModelForm):
                 # obj is locked by someone else!
                 self._locking_error_when_saving = 'locked_by_someone_else'
                 raise forms.ValidationError('Locking problem ! (Locked by someone else)')
+            elif lock_token:
+                if lock_token != obj.lock.token:
+                    # obj has been locked by current user in another window!
+                    self._locking_error_when_saving = 'was_already_locked'
+                    raise forms.ValidationError('Locking problem ! (Was already locked in another window/tab)')
             elif original_locked_at != obj.locked_at.replace(microsecond=0):
+                # No lock token was posted (e.g. custom fields/fieldsets),
+                # fall back to comparing lock dates
                 # obj has been locked by current user in another window!
                 self._locking_error_when_saving = 'was_already_locked'
                 raise forms.ValidationError('Locking problem ! (Was already locked in another window/tab)')
 
         return cleaned_data
+
+    def save(self, commit=True):
+        locked_fields = getattr(self, '_locked_fields', None)
+        if locked_fields:
+            # Write the fields of other users' groups back as they are now,
+            # not as they were when the object was loaded
+            obj = self.instance
+            attnames = [obj._meta.get_field(name).attname for name in locked_fields]
+            for values in obj.__class__._default_manager.filter(pk=obj.pk).values(*attnames):
+                for attname, value in values.items():
+                    setattr(obj, attname, value)
+        return super(LockableForm, self).save(commit)
+
+    def _clean_field_groups(self, cleaned_data):
+        """
+        Like ``clean``, for models with ``lock_field_groups``: only the groups
+        of the fields that were actually changed need to be locked by the user.
+        """
+        obj = self.instance
+        user = obj._request_user
+        locks = obj.field_group_locks()
+        if '' in locks and locks[''].lock_applies_to(user):
+            self._locking_error_when_saving = 'locked_by_someone_else'
+            raise forms.ValidationError('Locking problem ! (Locked by someone else)')
+        for group in obj.field_groups_for(self.changed_data):
+            lock = locks.get(group)
+            if lock is not None and lock.is_locked:
+                if not lock.is_locked_by(user):
+                    self._locking_error_when_saving = 'locked_by_someone_else'
+                    raise forms.ValidationError('Locking problem ! (Locked by someone else)')
+            elif cleaned_data['original_modified_at'] == obj.modified_at.replace(microsecond=0):
+                obj.lock_field_group_for(user, group)
+            else:
+                self._locking_error_when_saving = 'not_locked_and_modified'
+                raise forms.ValidationError('Locking problem ! (Not locked, was modified since)')
+        return cleaned_data
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Optional audit log of lock events (see ``LockEvent``).
+
+Enable it with ``LOCKING['history'] = True``. Events are not written right
+away: they are buffered in memory, per process, and written with a single
+``bulk_create`` at the end of each request, or as soon as
+``LOCKING['history_batch_size']`` events (100 by default) have piled up.
+``bulk_create`` requires Django 1.4 or later.
+"""
+import threading
+
+from django.conf import settings
+from django.core.signals import request_finished
+
+from locking import clock
+
+
+def is_enabled():
+    return settings.LOCKING.get('history', False)
+
+
+class EventBuffer(object):
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._events = []
+
+    def record(self, action, content_type_id, object_id, user_id=None, token=''):
+        if not is_enabled():
+            return
+        event = {
+            'action': action,
+            'content_type_id': content_type_id,
+            'object_id': str(object_id),
+            'user_id': user_id,
+            'token': token or '',
+            'happened_at': clock.now(),
+        }
+        self._mutex.acquire()
+        try:
+            self._events.append(event)
+            full = len(self._events) >= settings.LOCKING.get('history_batch_size', 100)
+        finally:
+            self._mutex.release()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered events to the database, in one query.
+        """
+        from locking.models import LockEvent
+
+        self._mutex.acquire()
+        try:
+            events, self._events = self._events, []
+        finally:
+            self._mutex.release()
+        if events:
+            LockEvent.objects.bulk_create([LockEvent(**event) for event in events])
+
+    def __len__(self):
+        return len(self._events)
+
+events = EventBuffer()
+
+
+def flush_events(sender, **kwargs):
+    events.flush()
+
+request_finished.connect(flush_events, dispatch_uid='locking.history.flush_events')
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Exports of the ``Lock`` table (model, object, user, age and type of each
+lock), as JSON Lines or CSV, for the ``locking_inventory`` command and the
+export of the ``Lock`` admin.
+
+Locks are read in chunks of ``chunk_size`` rows, paginated on the primary
+key, and the usernames of each chunk are fetched with one query, so that
+memory use doesn't grow with the size of the table. Locks kept in the rows
+of ``RowLockMixin`` models aren't in the ``Lock`` table, and aren't
+exported.
+"""
+import csv
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import models as auth
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.utils import simplejson
+
+from locking.models import Lock, _now
+
+STATES = ('active', 'expired', 'all')
+
+FIELDS = ('model', 'object_id', 'field_group', 'user_id', 'username',
+          'locked_at', 'expires_at', 'age', 'type', 'state')
+
+COLUMNS = ('pk', 'content_type', 'object_id', 'field_group', 'locked_by',
+           'locked_at', 'expires_at', 'hard_lock')
+
+
+def _legacy_since(now):
+    # Locks from before expires_at was introduced are active while locked_at
+    # is recent enough, as for LockableModel.is_locked
+    return now - timedelta(seconds=settings.LOCKING['time_until_expiration'])
+
+
+def _locks(state, now, content_type=None, user=None):
+    since = _legacy_since(now)
+    if state == 'active':
+        locks = Lock.objects.active() \
+            | Lock.objects.filter(expires_at__isnull=True, locked_at__gt=since)
+    elif state == 'expired':
+        locks = Lock.objects.expired().filter(models.Q(expires_at__isnull=False)
+            | models.Q(locked_at__isnull=True) | models.Q(locked_at__lte=since))
+    else:
+        locks = Lock.objects.all()
+    if content_type is not None:
+        locks = locks.filter(content_type=content_type)
+    if user is not None:
+        locks = locks.filter(locked_by=user)
+    return locks.order_by('pk')
+
+
+def _chunks(locks, chunk_size):
+    last_pk = None
+    while True:
+        chunk = locks
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        rows = list(chunk.values_list(*COLUMNS)[:chunk_size].iterator())
+        if not rows:
+            return
+        yield rows
+        last_pk = rows[-1][0]
+
+
+def lock_inventory(state='active', content_type=None, user=None, chunk_size=500):
+    """
+    Yields a dict for each lock, with the keys of ``FIELDS``.
+
+    ``state`` is ``active``, ``expired`` (expired and released locks) or
+    ``all``. ``content_type`` and ``user`` (instances or ids) restrict the
+    inventory to the locks on objects of a model, or held by a user.
+    """
+    if state not in STATES:
+        raise ValueError("Unknown lock state `%s`." % state)
+    now = _now()
+    legacy_since = _legacy_since(now)
+    for rows in _chunks(_locks(state, now, content_type, user), chunk_size):
+        user_ids = set(row[4] for row in rows if row[4] is not None)
+        usernames = dict(auth.User.objects.filter(pk__in=user_ids)
+                         .values_list('pk', 'username'))
+        for pk, ctype_id, object_id, field_group, user_id, locked_at, expires_at, hard_lock in rows:
+            ctype = ContentType.objects.get_for_id(ctype_id)
+            if expires_at is None:
+                is_active = locked_at is not None and locked_at > legacy_since
+            else:
+                is_active = expires_at > now
+            yield {
+                'model': '%s.%s' % (ctype.app_label, ctype.model),
+                'object_id': object_id,
+                'field_group': field_group,
+                'user_id': user_id,
+                'username': usernames.get(user_id),
+                'locked_at': locked_at and locked_at.isoformat(),
+                'expires_at': expires_at and expires_at.isoformat(),
+                'age': locked_at and int((now - locked_at).total_seconds()),
+                'type': hard_lock and 'hard' or 'soft',
+                'state': is_active and 'active' or 'expired',
+            }
+
+
+def as_json_lines(locks):
+    """
+    Yields a line of JSON for each lock of ``locks``, as produced by
+    ``lock_inventory``.
+    """
+    for lock in locks:
+        yield simplejson.dumps(lock) + '\n'
+
+
+class _Line(object):
+    # File-like object that keeps the last line written by a csv writer
+    def write(self, line):
+        self.line = line
+
+
+def as_csv(locks):
+    """
+    Yields a header line, then a line of CSV for each lock of ``locks``.
+    """
+    line = _Line()
+    writer = csv.writer(line)
+    writer.writerow(FIELDS)
+    yield line.line
+    for lock in locks:
+        writer.writerow([lock[name] is not None and unicode(lock[name]).encode('utf-8') or ''
+                         for name in FIELDS])
+        yield line.line
+
+FORMATS = {
+    'jsonl': (as_json_lines, 'application/x-ndjson'),
+    'csv': (as_csv, 'text/csv'),
+}
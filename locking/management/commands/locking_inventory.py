@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+
+from locking import inventory
+
+
+class Command(BaseCommand):
+    help = ("Writes the locks of the Lock table (model, object, user, age and "
+            "type of each lock) as JSON Lines or CSV, reading them in chunks "
+            "so that memory use doesn't depend on the number of locks.")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=sorted(inventory.FORMATS), default='jsonl',
+            help='Output format: jsonl (default) or csv.'),
+        make_option('--state', choices=inventory.STATES, default='active',
+            help='Locks to export: active (default), expired (expired or released) or all.'),
+        make_option('--model', default=None,
+            help='Only export locks on objects of this model (app_label.model).'),
+        make_option('--user', default=None,
+            help='Only export locks held by the user with this username.'),
+        make_option('--chunk-size', type='int', default=500,
+            help='Number of locks read per query.'),
+    )
+
+    def handle(self, *args, **options):
+        content_type = user = None
+        if options['model']:
+            try:
+                app_label, model = options['model'].lower().split('.')
+                content_type = ContentType.objects.get_by_natural_key(app_label, model)
+            except (ValueError, ContentType.DoesNotExist):
+                raise CommandError("Unknown model `%s`, use app_label.model." % options['model'])
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError("Unknown user `%s`." % options['user'])
+
+        locks = inventory.lock_inventory(options['state'], content_type, user,
+                                         chunk_size=options['chunk_size'])
+        write = inventory.FORMATS[options['format']][0]
+        for line in write(locks):
+            self.stdout.write(line)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.utils import simplejson
+
+
+class Command(BaseCommand):
+    help = ("Simulates concurrent editors working on locking.tests stories "
+            "through the LockableAdmin views, and reports throughput, "
+            "latencies, conflicts and lost updates. Runs against a freshly "
+            "created test database; needs `locking.tests` in INSTALLED_APPS "
+            "and the admin in the urlconf.")
+    option_list = BaseCommand.option_list + (
+        make_option('--editors', type='int', default=10,
+            help='Number of concurrent editors.'),
+        make_option('--stories', type='int', default=3,
+            help='Number of stories the editors compete for.'),
+        make_option('--rounds', type='int', default=10,
+            help='Number of stories each editor opens.'),
+        make_option('--heartbeats', type='int', default=2,
+            help='Number of lock refreshes per opened story.'),
+        make_option('--save-ratio', type='float', default=0.5,
+            help='Share of opened stories that get saved, the others are closed.'),
+        make_option('--think-time', type='float', default=0.01,
+            help='Seconds an editor waits between requests.'),
+        make_option('--json', action='store_true', default=False,
+            help='Output the report as JSON.'),
+    )
+
+    def handle(self, *args, **options):
+        if 'locking.tests' not in settings.INSTALLED_APPS:
+            raise CommandError("Add `locking.tests` to INSTALLED_APPS to run the load test.")
+        from django.test.utils import setup_test_environment, teardown_test_environment
+        from locking.tests.loadtest import LoadTest
+
+        # Other aliases of the default database, such as the one of
+        # LOCKING['database'], have to use the test database as well
+        mirrors = [alias for alias in connections
+                   if connections[alias].settings_dict.get('TEST_MIRROR') == DEFAULT_DB_ALIAS]
+        lock_alias = settings.LOCKING.get('database')
+        if lock_alias and lock_alias != DEFAULT_DB_ALIAS:
+            if lock_alias not in mirrors:
+                raise CommandError("LOCKING['database'] is %r, which isn't a TEST_MIRROR "
+                                   "of the default database." % lock_alias)
+            if connections[lock_alias].vendor == 'sqlite':
+                raise CommandError("LOCKING['database'] needs a database with row-level "
+                                   "locking, SQLite locks the whole file.")
+
+        # Editors run in threads, each with its own connection, so an
+        # in-memory SQLite database won't do
+        db_file = None
+        if connection.vendor == 'sqlite':
+            db_file = tempfile.mkstemp(suffix='.sqlite')[1]
+            connection.settings_dict['TEST_NAME'] = db_file
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        for alias in mirrors:
+            connections[alias].close()
+            connections[alias].settings_dict['NAME'] = connection.settings_dict['NAME']
+        try:
+            report = LoadTest(
+                editors=options['editors'],
+                stories=options['stories'],
+                rounds=options['rounds'],
+                heartbeats=options['heartbeats'],
+                save_ratio=options['save_ratio'],
+                think_time=options['think_time'],
+            ).run()
+        finally:
+            for alias in mirrors:
+                connections[alias].close()
+                connections[alias].settings_dict['NAME'] = old_name
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            if db_file and os.path.exists(db_file):
+                os.remove(db_file)
+
+        if options['json']:
+            self.stdout.write(simplejson.dumps(report, indent=2) + '\n')
+            return
+
+        self.stdout.write("%(requests)d requests in %(duration).2fs (%(throughput).1f req/s)\n" % report)
+        for view, latency in sorted(report['latency'].items()):
+            self.stdout.write("  %-14s p50 %7.1fms  p99 %7.1fms\n" % (view,
+                latency['p50'] * 1000, latency['p99'] * 1000))
+        self.stdout.write("%(opened)d change forms opened, %(conflicts)d conflicts "
+                          "(%(conflict_rate).1f%%)\n" % dict(report,
+                          conflict_rate=report['conflict_rate'] * 100))
+        self.stdout.write("%(saved)d saves, %(lost_updates)d lost updates, "
+                          "%(errors)d errors\n" % report)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+import uuid
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, models, transaction
+from django.db.models.query import QuerySet
+
+from locking import clock, dbclock
+
+
+class LockQuerySet(QuerySet):
+    def release(self):
+        """
+        Deletes the locks and returns the number of locks that were deleted:
+        a conditional release, e.g. of the lock that still has a given token.
+
+        The locks are first claimed with a conditional UPDATE that gives them
+        a token of their own, then deleted by that token, so that a lock taken
+        over between the two isn't deleted.
+        """
+        if transaction.is_managed(using=self.db):
+            return self._release()
+        with transaction.commit_on_success(using=self.db):
+            return self._release()
+
+    def _release(self):
+        claim = uuid.uuid4().hex
+        released = self.update(token=claim)
+        if released:
+            self.model._default_manager.using(self.db).filter(token=claim).delete()
+        return released
+
+
+class LockManager(models.Manager):
+    """
+    Range queries on ``Lock.expires_at``, compared with the web server's time
+    or with the database's (see ``locking.dbclock``).
+    """
+    def get_query_set(self):
+        return LockQuerySet(self.model, using=self._db)
+
+    def _expires(self, queryset, operator, seconds=0, or_null=False):
+        if dbclock.is_enabled():
+            column = connection.ops.quote_name(self.model._meta.get_field('expires_at').column)
+            condition = "%s %s %s" % (column, operator, dbclock.from_now_sql(seconds))
+            if or_null:
+                condition = "(%s IS NULL OR %s)" % (column, condition)
+            return queryset.extra(where=[condition])
+        lookup = {'>': 'gt', '<=': 'lte'}[operator]
+        condition = models.Q(**{'expires_at__%s' % lookup: clock.now() + timedelta(seconds=seconds)})
+        if or_null:
+            condition |= models.Q(expires_at__isnull=True)
+        return queryset.filter(condition)
+
+    def active(self):
+        return self._expires(self.all(), '>')
+
+    def expired(self):
+        """
+        Locks that have expired or have been released.
+        """
+        return self._expires(self.all(), '<=', or_null=True)
+
+    def expiring_soon(self, seconds=None):
+        """
+        Active locks that expire within ``seconds``, by default the time
+        between the expiry warning and the expiry itself.
+        """
+        if seconds is None:
+            seconds = settings.LOCKING['time_until_expiration'] - settings.LOCKING['time_until_warning']
+        return self._expires(self.active(), '<=', seconds)
+
+    def sweep(self):
+        """
+        Deletes expired and released locks.
+        """
+        self.expired().delete()
+
+
+class LockEventManager(models.Manager):
+    """
+    Reporting queries on the lock history.
+    """
+    def most_contended(self, limit=10):
+        """
+        Returns the objects on which users most often bumped into somebody
+        else's lock, as dicts with ``content_type``, ``object_id`` and
+        ``conflicts`` keys, most contended first.
+        """
+        return self.filter(action='conflict') \
+            .values('content_type', 'object_id') \
+            .annotate(conflicts=models.Count('id')) \
+            .order_by('-conflicts')[:limit]
+
+    def average_hold_time(self):
+        """
+        Returns a dict that maps each locked model to the average number of
+        seconds its locks were held, from acquisition to the last refresh or
+        release of the same lock token.
+        """
+        holds = self.exclude(token='') \
+            .exclude(action='conflict') \
+            .values('content_type', 'token') \
+            .annotate(start=models.Min('happened_at'), end=models.Max('happened_at'))
+        totals = {}
+        for hold in holds:
+            seconds = (hold['end'] - hold['start']).total_seconds()
+            total, count = totals.get(hold['content_type'], (0, 0))
+            totals[hold['content_type']] = (total + seconds, count + 1)
+        return dict((ContentType.objects.get_for_id(ctype_id).model_class(), total / count)
+                    for ctype_id, (total, count) in totals.items())
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from django.utils import simplejson
+
+from locking import logger
+from locking.costs import KINDS, counted_connections, recorder
+
+
+class LockCostMiddleware(object):
+    """
+    Reports the cost of the locking layer for each request (see
+    ``locking.costs``): per kind of operation, how many were done, how many
+    queries they ran and how long they took. The totals are sent in a
+    ``Server-Timing`` header, and logged as JSON.
+
+    Queries are counted through Django's debug cursor, which this middleware
+    turns on for the duration of the request, on the connections of
+    ``locking.costs.counted_connections``.
+    """
+    def process_request(self, request):
+        request._locking_debug_cursors = []
+        for connection in counted_connections():
+            request._locking_debug_cursors.append((connection, connection.use_debug_cursor))
+            connection.use_debug_cursor = True
+        recorder.start()
+
+    def process_response(self, request, response):
+        if not recorder.is_active:
+            return response
+        totals = recorder.stop()
+        for connection, use_debug_cursor in getattr(request, '_locking_debug_cursors', ()):
+            connection.use_debug_cursor = use_debug_cursor
+        timings = ['locking.%s;dur=%.1f;desc="%d ops, %d queries"' % (kind,
+                       totals[kind]['time'] * 1000, totals[kind]['count'], totals[kind]['queries'])
+                   for kind in KINDS if totals[kind]['count']]
+        if timings:
+            if response.has_header('Server-Timing'):
+                timings.insert(0, response['Server-Timing'])
+            response['Server-Timing'] = ', '.join(timings)
+        logger.info(u"Lock costs for %s %s: %s" % (request.method, request.path,
+                                                   simplejson.dumps(totals, sort_keys=True)))
+        return response
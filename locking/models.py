@@ -1,20 +1,44 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime, timedelta
+import time
+import uuid
 
 from django.conf import settings
 from django.contrib.auth import models as auth
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
-from django.db import models
+from django.db import IntegrityError, models, router, transaction
+from django.db.models.query import QuerySet
+from django.db.models.signals import class_prepared
 from django.db.models.expressions import ExpressionNode
 from django.utils.translation import ugettext_lazy as _
 
+from locking import breaker
+from locking import clock
+from locking import costs
+from locking import dbclock
+from locking import history
 from locking import logger
 from locking import managers
+from locking import signals
+from locking import statuses
+from locking.snapshots import LockInfo
+from locking.waiters import waiters
 
 class ObjectLockedError(IOError):
     pass
 
+def _now():
+    # The time new locks are dated with, see ``locking.dbclock``
+    if dbclock.is_enabled():
+        return dbclock.now()
+    return clock.now()
+
+def _lease(expires_in=None):
+    if expires_in is None:
+        expires_in = settings.LOCKING['time_until_expiration']
+    return timedelta(seconds=expires_in)
+
 class Lock(models.Model):
     """
     Model containing the lock informations per object.
@@ -28,6 +52,14 @@ class Lock(models.Model):
         null=True,
         editable=False)
     hard_lock = models.BooleanField(db_column='hard_lock', default=False, editable=False)
+    expires_at = models.DateTimeField(db_column='expires_at', null=True, db_index=True,
+        editable=False)
+    # Opaque token identifying one acquisition of the lock (i.e. one window/tab)
+    token = models.CharField(db_column='token', max_length=32, blank=True, db_index=True,
+        editable=False)
+    # Name of the locked group of fields, empty when the whole object is locked
+    field_group = models.CharField(db_column='field_group', max_length=32, blank=True,
+        default='', editable=False)
 
     # Content-object field
     content_type   = models.ForeignKey(ContentType,
@@ -36,13 +68,45 @@ class Lock(models.Model):
     object_id      = models.TextField(_('object ID'))
     content_object = generic.GenericForeignKey('content_type', 'object_id')
 
+    objects = managers.LockManager()
+
     class Meta:
-         unique_together = ('content_type', 'object_id',)
+         unique_together = ('content_type', 'object_id', 'field_group',)
 
 
     def __unicode__(self):
+        if self.field_group:
+            return u"Lock for %d/%s (%s)" % (self.content_type_id, self.object_id, self.field_group)
         return u"Lock for %d/%s" % (self.content_type_id, self.object_id)
 
+class LockEvent(models.Model):
+    """
+    Audit log of locks, see ``locking.history``.
+    """
+    ACTION_CHOICES = (
+        ('lock', _('lock')),
+        ('refresh', _('refresh')),
+        ('unlock', _('unlock')),
+        ('conflict', _('conflict')),
+    )
+
+    action = models.CharField(max_length=8, choices=ACTION_CHOICES)
+    happened_at = models.DateTimeField(db_index=True)
+    user = models.ForeignKey(auth.User, null=True, related_name="lock_events")
+    token = models.CharField(max_length=32, blank=True)
+
+    content_type = models.ForeignKey(ContentType,
+            verbose_name=_('content type'),
+            related_name="content_type_set_for_%(class)s")
+    object_id = models.TextField(_('object ID'))
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+
+    objects = managers.LockEventManager()
+
+    def __unicode__(self):
+        return u"%s on %d/%s at %s" % (self.action, self.content_type_id,
+            self.object_id, self.happened_at)
+
 class LockableModelFieldsMixin(models.Model):
     """
     Mixin that adds modified_at column
@@ -65,42 +129,189 @@ class LockableModelMethodsMixin(models.Model):
 
     Inherit directly from this class (instead of LockableModel) if you want
     to declare your locking fields with custom options (on_delete, blank, etc.).
+
+    Set ``lock_parent`` to the name of a ForeignKey to another lockable model
+    to have this object covered by the lock of its parent (e.g. inlines of a
+    change form), instead of having locks of its own.
+
+    Set ``lock_field_groups`` to a dict of group names to field names to allow
+    different users to lock different parts of the same object, see
+    ``lock_field_group_for``.
+
+    Set ``lock_fail_open`` to False to have objects look hard-locked rather
+    than unlocked while the lock store is unavailable, see ``locking.breaker``.
+    Either way, existing objects can't be saved meanwhile, since somebody may
+    hold a hard lock on them.
     """
     class Meta:
         abstract = True
 
+    lock_parent = None
+    lock_field_groups = {}
+    lock_fail_open = True
+
+    def _lock_key(self):
+        """
+        Returns the content type and object id of the lock that applies to
+        this object: its own, or its parent's if ``lock_parent`` is set.
+        """
+        with costs.measure('contenttype'):
+            if self.lock_parent:
+                field = self._meta.get_field(self.lock_parent)
+                return ContentType.objects.get_for_model(field.rel.to), getattr(self, field.attname)
+            return ContentType.objects.get_for_model(self), self.pk
+
     @property
     def lock(self):
         if not hasattr(self, '_lock'):
-            ctypes = ContentType.objects.get_for_model(self)
+            ctypes, object_id = self._lock_key()
+
+            def fetch():
+                try:
+                    if object_id is None:
+                        raise Lock.DoesNotExist
+                    locks = Lock.objects.all()
+                    if dbclock.is_enabled():
+                        # Fetch the database's time along with the lock
+                        locks = locks.extra(select={'db_now': dbclock.now_sql()})
+                    return locks.get(content_type=ctypes, object_id=str(object_id),
+                                     field_group='')
+                except Lock.DoesNotExist:
+                    # If there is no Lock object for this model, create it,
+                    # but don't save it yet (it's just here to prevent the db
+                    # query next time we need the lock information for this object)
+                    return Lock(content_type=ctypes, object_id=str(object_id))
+
             try:
-                self._lock = Lock.objects.get(content_type=ctypes, object_id=str(self.pk))
-            except Lock.DoesNotExist:
-                # If there is no Lock object for this model, create it,
-                # but don't save it yet (it's just here to prevent the db
-                # query next time we need the lock information for this object)
-                self._lock = Lock(content_type=ctypes, object_id=str(self.pk))
+                with costs.measure('lock_read'):
+                    self._lock = breaker.call(fetch, self._lock_database())
+            except breaker.Unavailable:
+                self._lock = self._unavailable_lock(ctypes, object_id)
         return self._lock
 
+    def _unavailable_lock(self, content_type, object_id):
+        """
+        Stands in for the lock while the lock store is unavailable (see
+        ``locking.breaker``): no lock if this model fails open, a hard lock
+        held by nobody otherwise. It's marked ``unavailable``, see
+        ``_lock_unavailable``.
+        """
+        lock = Lock(content_type=content_type, object_id=str(object_id))
+        lock.unavailable = True
+        if not self.lock_fail_open:
+            now = clock.now()
+            lock.locked_at, lock.expires_at, lock.hard_lock = now, now + _lease(), True
+        return lock
+
+    def _lock_unavailable(self):
+        # Whether the lock couldn't be read, and may be a hard lock
+        return getattr(self.lock, 'unavailable', False)
+
+    def _lock_database(self):
+        # The database alias locks are read from and written to
+        return router.db_for_write(Lock)
+
+    def _guard(self, operation, hard_lock=False):
+        # Runs a lock write through the circuit breaker, see ``locking.breaker``
+        try:
+            return breaker.call(operation, self._lock_database())
+        except breaker.Unavailable:
+            if hard_lock or not self.lock_fail_open:
+                raise ObjectLockedError("The lock store is unavailable.")
+
     @lock.deleter
     def lock(self):
         del self._lock
 
+    def _lock_now(self):
+        """
+        Returns the time lock dates are compared with: the web server's time,
+        or the database's time as of when the lock was fetched (see
+        ``locking.dbclock``).
+        """
+        if not dbclock.is_enabled():
+            return clock.now()
+        if getattr(self.lock, 'db_now', None) is None:
+            self.lock.db_now = dbclock.now()
+        return dbclock.parse(self.lock.db_now)
+
+    def _lock_queryset(self, field_group=''):
+        ctype, object_id = self._lock_key()
+        locks = Lock.objects.filter(content_type=ctype, object_id=str(object_id))
+        if field_group is not None:
+            locks = locks.filter(field_group=field_group)
+        return locks
+
+    def _record_event(self, action, user_id=None, token=''):
+        ctype, object_id = self._lock_key()
+        history.events.record(action, ctype.pk, object_id, user_id, token)
+
+    @property
+    def lock_info(self):
+        """
+        An immutable ``LockInfo`` snapshot of the current lock, see
+        ``locking.snapshots``. Unless the lock has been fetched already, it
+        comes from the lock status cache if that's enabled (see
+        ``locking.statuses``): use it to display lock status, not to decide
+        whether the object may be locked or saved.
+        """
+        if hasattr(self, '_lock') or not statuses.is_enabled():
+            if dbclock.is_enabled():
+                # Date the snapshot with the database's time
+                self._lock_now()
+            return LockInfo.from_lock(self.lock)
+        ctype, object_id = self._lock_key()
+        if object_id is None:
+            return LockInfo(ctype.pk, object_id)
+
+        def fetch():
+            with costs.measure('lock_read'):
+                infos = breaker.call(lambda: LockInfo.from_queryset(self._lock_queryset()),
+                                     self._lock_database())
+            return infos and infos[0] or LockInfo(ctype.pk, object_id)
+
+        try:
+            return statuses.cache.get(ctype.pk, object_id, fetch)
+        except breaker.Unavailable:
+            return LockInfo.from_lock(self._unavailable_lock(ctype, object_id))
+
+    def _forget_lock_info(self):
+        """
+        Invalidates the snapshot of this object's lock in the lock status
+        cache, after writing the lock (see ``locking.statuses``).
+        """
+        if statuses.is_enabled():
+            ctype, object_id = self._lock_key()
+            statuses.cache.forget([(ctype.pk, object_id)])
+
+    def _may_be_locked(self):
+        # New objects have no lock yet, unless they're covered by their parent's
+        return bool(self.pk or self.lock_parent)
+
     @property
     def locked_at(self):
-        if not self.pk:
+        if not self._may_be_locked():
             return None
         return self.lock.locked_at
 
     @locked_at.setter
     def locked_at(self, value):
         self.lock.locked_at = value
+        self.lock.expires_at = value and value + _lease()
+
+    @property
+    def expires_at(self):
+        if not self._may_be_locked():
+            return None
+        return self.lock.expires_at
 
     @property
     def locked_by(self):
-        if not self.pk:
+        if not self._may_be_locked():
             return None
-        return self.lock.locked_by
+        lock = self.lock
+        with costs.measure('user_load'):
+            return lock.locked_by
 
     @locked_by.setter
     def locked_by(self, value):
@@ -108,7 +319,7 @@ class LockableModelMethodsMixin(models.Model):
 
     @property
     def hard_lock(self):
-        if not self.pk:
+        if not self._may_be_locked():
             return False
         return self.lock.hard_lock
 
@@ -134,9 +345,12 @@ class LockableModelMethodsMixin(models.Model):
         A read-only property that returns True or False.
         Works by calculating if the last lock (self.locked_at) has timed out or not.
         """
+        if isinstance(self.expires_at, datetime):
+            return self.expires_at > self._lock_now()
         if isinstance(self.locked_at, datetime):
-            # We're only locked if locked_at is recent enough
-            if self.locked_at > datetime.now() - timedelta(seconds=settings.LOCKING['time_until_expiration']):
+            # Locks from before expires_at was introduced:
+            # we're only locked if locked_at is recent enough
+            if self.locked_at > self._lock_now() - timedelta(seconds=settings.LOCKING['time_until_expiration']):
                 return True
             else:
                 return False
@@ -154,9 +368,12 @@ class LockableModelMethodsMixin(models.Model):
         If you want to extend a lock beyond its current expiry date, initiate a new
         lock using the ``lock_for`` method.
         """
-        return int(settings.LOCKING['time_until_expiration'] - (datetime.now() - self.locked_at).total_seconds())
+        if self.expires_at is not None:
+            return int((self.expires_at - self._lock_now()).total_seconds())
+        return int(settings.LOCKING['time_until_expiration'] - (self._lock_now() - self.locked_at).total_seconds())
 
-    def lock_for(self, user, hard_lock=False):
+    @costs.measured('lock_write')
+    def lock_for(self, user, hard_lock=False, renew=False, expires_in=None, token=None):
         """
         Together with ``unlock_for`` this is probably the most important method
         on this model. If applicable to your use-case, you should lock for a specific
@@ -168,44 +385,342 @@ class LockableModelMethodsMixin(models.Model):
         without first unlocking will raise an ``ObjectLockedError``.
 
         Don't use hard locks unless you really need them. See :doc:`design`.
+
+        Returns the token of this acquisition, which can be handed to
+        ``refresh_lock`` and ``unlock_for`` to make sure they only act on this
+        very lock (and not on one taken by the same user in another window).
+
+        If the user already holds the same kind of lock and it was taken or
+        refreshed less than ``LOCKING['min_refresh_interval']`` seconds ago,
+        nothing is written and the current token is returned, unless ``renew``
+        is True (e.g. when another window of the same user takes over the lock).
+
+        The lock expires after ``expires_in`` seconds, which defaults to
+        ``LOCKING['time_until_expiration']``.
+
+        Pass a ``token`` to use it instead of a new one, e.g. to lock several
+        objects with the same token (see ``locking.sessions``).
         """
         logger.info(u"Attempting to initiate a lock for user `%s`" % user)
 
         if not isinstance(user, auth.User):
             raise ValueError("You should pass a valid auth.User to lock_for.")
 
-        if self.lock_applies_to(user):
+        if self.lock_applies_to(user) or self._field_groups_apply_to(user):
+            self._record_event('conflict', user.pk)
             raise ObjectLockedError("This object is already locked by another user. \
                 May not override, except through the `unlock` method.")
+
+        lock = self.lock
+        now = _now()
+        if not renew and token in (None, lock.token) \
+                and self._is_recent_lock(user, hard_lock, now, now + _lease(expires_in)):
+            logger.info(u"Lock for `%s` is recent enough, not refreshing it" % user)
+            return lock.token
+
+        # Only write the columns that actually change
+        changes = {'locked_at': now, 'expires_at': now + _lease(expires_in),
+                   'token': token or uuid.uuid4().hex}
+        if lock.locked_by_id != user.pk:
+            changes['locked_by'] = user
+        if lock.hard_lock != hard_lock:
+            changes['hard_lock'] = hard_lock
+        for name, value in changes.items():
+            setattr(lock, name, value)
+        lock.db_now = now
+        self._guard(lambda: self._write_lock(user, changes, now), hard_lock)
+        logger.info(u"Initiated a %s lock for `%s` at %s" % (self.lock_type, user, self.locked_at))
+        self._record_event('lock', user.pk, lock.token)
+        return lock.token
+
+    def _write_lock(self, user, changes, now):
+        lock = self.lock
+        if not lock.pk or not self._lock_queryset().update(**changes):
+            # No lock row yet (or it was removed in the meantime)
+            lock.pk = None
+            lock.save()
+        self._forget_lock_info()
+
+    def _field_groups_apply_to(self, user):
+        if not self.lock_field_groups:
+            return False
+        return any(info.lock_applies_to(user) for info in self.field_group_locks().values())
+
+    @costs.measured('lock_read')
+    def field_group_locks(self):
+        """
+        Returns the locks of this object, whole-object lock included (as the
+        ``''`` group), as a dict of group names to ``LockInfo``, in one query.
+        Groups that have never been locked are left out.
+
+        While the lock store is unavailable, there are no locks, or only a
+        hard lock on the whole object if this model doesn't fail open.
+        """
+        def fetch():
+            return list(self._lock_queryset(field_group=None)
+                        .values_list('field_group', *LockInfo.fields))
+        try:
+            rows = breaker.call(fetch, self._lock_database())
+        except breaker.Unavailable:
+            if self.lock_fail_open:
+                return {}
+            ctype, object_id = self._lock_key()
+            return {'': LockInfo.from_lock(self._unavailable_lock(ctype, object_id))}
+        return dict((row[0], LockInfo.from_row(row[1:])) for row in rows)
+
+    def fields_locked_for(self, user):
+        """
+        Returns the names of the fields of the groups somebody else than
+        ``user`` holds the lock of.
+        """
+        locks = self.field_group_locks()
+        return [field for group, fields in self.lock_field_groups.items()
+                if group in locks and locks[group].lock_applies_to(user)
+                for field in fields]
+
+    def field_groups_for(self, field_names):
+        """
+        Returns the names of the field groups that contain any of ``field_names``.
+        """
+        return [group for group, fields in self.lock_field_groups.items()
+                if set(fields) & set(field_names)]
+
+    @costs.measured('lock_write')
+    def lock_field_group_for(self, user, field_group, hard_lock=False, expires_in=None):
+        """
+        Like ``lock_for``, but only locks the fields of ``field_group`` (see
+        ``lock_field_groups``), so that other users can still lock and edit the
+        other groups. Fails if the group or the whole object is locked by
+        another user. Returns the token of this acquisition.
+        """
+        if field_group not in self.lock_field_groups:
+            raise ValueError("Unknown field group `%s`." % field_group)
+
+        locks = self.field_group_locks()
+        for name in ('', field_group):
+            if name in locks and locks[name].lock_applies_to(user):
+                self._record_event('conflict', user.pk)
+                raise ObjectLockedError("This group of fields is already locked by another user.")
+
+        now = _now()
+        values = {
+            'locked_at': now,
+            'expires_at': now + _lease(expires_in),
+            'locked_by': user,
+            'hard_lock': hard_lock,
+            'token': uuid.uuid4().hex,
+        }
+        if not self._take_field_group(field_group, user, values, now):
+            self._record_event('conflict', user.pk)
+            raise ObjectLockedError("This group of fields is already locked by another user.")
+        logger.info(u"Initiated a lock on `%s` of `%s` for `%s`" % (field_group, self, user))
+        self._record_event('lock', user.pk, values['token'])
+        return values['token']
+
+    def _take_field_group(self, field_group, user, values, now):
+        # Insert or update: take the group's lock row if it's free or ours,
+        # or create it, in case somebody else did since it was read
+        available = models.Q(expires_at__isnull=True) | models.Q(expires_at__lte=now) \
+            | models.Q(locked_by=user)
+        locks = self._lock_queryset(field_group).filter(available)
+        if locks.update(**values):
+            return True
+        ctype, object_id = self._lock_key()
+        using = self._lock_database()
+        sid = transaction.is_managed(using=using) and transaction.savepoint(using=using)
+        try:
+            Lock.objects.create(content_type=ctype, object_id=str(object_id),
+                                field_group=field_group, **values)
+        except IntegrityError:
+            if sid:
+                transaction.savepoint_rollback(sid, using=using)
+            return bool(locks.update(**values))
+        if sid:
+            transaction.savepoint_commit(sid, using=using)
+        return True
+
+    @costs.measured('lock_write')
+    def unlock_field_groups_for(self, user):
+        """
+        Releases all field group locks ``user`` holds on this object.
+        """
+        self._lock_queryset(field_group=None).filter(locked_by=user) \
+            .exclude(field_group='').delete()
+        logger.info(u"Disengaged field group locks on `%s` for `%s`" % (self, user))
+
+    def _is_recent_lock(self, user, hard_lock, now, expires_at):
+        # Whether the user's lock was taken less than min_refresh_interval
+        # ago, and already lasts until expires_at, give or take that interval
+        interval = settings.LOCKING.get('min_refresh_interval', 0)
+        lock = self.lock
+        return bool(interval and lock.pk and lock.token and lock.locked_at
+                    and lock.locked_by_id == user.pk and lock.hard_lock == hard_lock
+                    and lock.locked_at > now - timedelta(seconds=interval)
+                    and lock.expires_at and lock.expires_at > now
+                    and lock.expires_at >= expires_at - timedelta(seconds=interval))
+
+    def _forget_lock(self):
+        # The lock was changed by an UPDATE, fetch it again when needed
+        if hasattr(self, '_lock'):
+            del self.lock
+
+    @costs.measured('lock_write')
+    def refresh_lock(self, token, expires_in=None):
+        """
+        Extends the lock identified by ``token`` (as returned by ``lock_for``),
+        in a single conditional UPDATE. Returns False if that lock has been
+        released or taken over in the meantime, in which case nothing changes.
+
+        Refreshes less than ``LOCKING['min_refresh_interval']`` seconds after
+        the previous one are not written, unless they extend the lock by more
+        than that interval (e.g. with a longer ``expires_in``).
+
+        The lock is extended by ``expires_in`` seconds, which defaults to
+        ``LOCKING['time_until_expiration']``.
+
+        Returns False as well while the lock store is unavailable, see
+        ``locking.breaker``.
+        """
+        if not token:
+            return False
+        try:
+            return breaker.call(lambda: self._refresh_lock(token, expires_in),
+                                self._lock_database())
+        except breaker.Unavailable:
+            # Whether the lock is still ours can't be told
+            return False
+
+    def _refresh_lock(self, token, expires_in):
+        locked_at = _now()
+        expires_at = locked_at + _lease(expires_in)
+        locks = self._lock_queryset().filter(token=token)
+        interval = settings.LOCKING.get('min_refresh_interval', 0)
+        if interval:
+            # Skip the write if the lock was refreshed recently and already
+            # lasts about as long as requested
+            interval = timedelta(seconds=interval)
+            stale = models.Q(locked_at__lt=locked_at - interval) \
+                | models.Q(expires_at__lt=expires_at - interval) | models.Q(expires_at__isnull=True)
+            if not locks.filter(stale).update(locked_at=locked_at, expires_at=expires_at):
+                # Either refreshed recently, or not our lock anymore
+                return locks.filter(expires_at__gt=locked_at).exists()
+        elif not locks.update(locked_at=locked_at, expires_at=expires_at):
+            return False
+        if hasattr(self, '_lock'):
+            self._lock.locked_at = self._lock.db_now = locked_at
+            self._lock.expires_at = expires_at
         else:
-            self.lock.locked_at = datetime.now()
-            self.lock.locked_by = user
-            self.lock.hard_lock = hard_lock
-            self.lock.save()
-            logger.info(u"Initiated a %s lock for `%s` at %s" % (self.lock_type, self.locked_by, self.locked_at))
+            self._forget_lock()
+        self._forget_lock_info()
+        if history.is_enabled():
+            if hasattr(self, '_lock'):
+                user_id = self._lock.locked_by_id
+            else:
+                user_id = locks.values_list('locked_by', flat=True)[:1]
+                user_id = user_id and user_id[0] or None
+            self._record_event('refresh', user_id, token)
+        return True
 
+    def acquire(self, user, hard_lock=False, timeout=None, poll=None):
+        """
+        Like ``lock_for``, but instead of raising ``ObjectLockedError`` right
+        away when another user holds the lock, waits until the lock is released
+        or expires.
+
+        Waiters within the same process get the lock in the order in which they
+        asked for it, and are woken up as soon as ``unlock`` or ``unlock_for``
+        is called. Locks released by other processes or that expire are picked
+        up by re-checking the lock every ``poll`` seconds (defaults to
+        ``LOCKING['acquire_poll']``, or 1 second).
+
+        ``timeout`` is the maximum number of seconds to wait; ``None`` waits
+        forever. Raises ``ObjectLockedError`` when the timeout passes.
+        """
+        if poll is None:
+            poll = settings.LOCKING.get('acquire_poll', 1)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        ctype, object_id = self._lock_key()
+        key = (ctype.pk, str(object_id))
+
+        waiter = waiters.enqueue(key)
+        try:
+            while True:
+                if waiters.is_first(key, waiter):
+                    # Clear before trying, so that a release happening between
+                    # our attempt and the wait below isn't missed.
+                    waiter.clear()
+                    try:
+                        return self.lock_for(user, hard_lock=hard_lock)
+                    except ObjectLockedError:
+                        pass
+                wait = poll
+                if timeout is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ObjectLockedError("Timed out while waiting for the lock on this object.")
+                    wait = min(wait, remaining)
+                waiter.wait(wait)
+                # Fetch the current lock again on the next attempt
+                if hasattr(self, '_lock'):
+                    del self.lock
+        finally:
+            waiters.remove(key, waiter)
+
+    @costs.measured('lock_write')
     def unlock(self):
         """
         This method serves solely to allow the application itself or admin users
         to do manual lock overrides, even if they haven't initiated these
         locks themselves. Otherwise, use ``unlock_for``.
         """
-        if self.lock.pk:
-            self.lock.delete()
+        lock = self.lock
+        if lock.pk:
+            # Deleting a row lock clears its columns
+            user_id, token = lock.locked_by_id, lock.token
+            lock.delete()
+            self._record_event('unlock', user_id, token)
+        if self.lock_field_groups:
+            self._lock_queryset(field_group=None).delete()
         del self.lock
+        self._forget_lock_info()
         logger.info(u"Disengaged lock on `%s`" % self)
+        signals.lock_released.send(sender=self.__class__,
+                                   content_type_id=lock.content_type_id,
+                                   object_id=lock.object_id)
 
-    def unlock_for(self, user):
+    @costs.measured('lock_write')
+    def unlock_for(self, user, token=None):
         """
         See ``lock_for``. If the lock was initiated for a specific user,
         unlocking will fail unless that same user requested the unlocking.
         Manual overrides should use the ``unlock`` method instead.
 
+        If ``token`` is given, only the lock acquisition it identifies is
+        released, in a single conditional query.
+
         Will raise a ObjectLockedError exception when the current user isn't authorized to
         unlock the object.
         """
+        self._guard(lambda: self._unlock_for(user, token))
+
+    def _unlock_for(self, user, token=None):
         logger.info(u"Attempting to open up a lock on `%s` by user `%s`" % (self, user))
 
+        if token:
+            released = self._lock_queryset().filter(token=token, locked_by=user).release()
+            if not released:
+                raise ObjectLockedError("Trying to unlock a lock that isn't held with this token anymore.")
+            self._record_event('unlock', user.pk, token)
+            self._forget_lock()
+            logger.info(u"Disengaged lock on `%s`" % self)
+            ctype, object_id = self._lock_key()
+            self._forget_lock_info()
+            signals.lock_released.send(sender=self.__class__,
+                                       content_type_id=ctype.pk,
+                                       object_id=str(object_id))
+            return
+
         # refactor: should raise exceptions instead
         if self.is_locked_by(user):
             self.unlock()
@@ -237,15 +752,219 @@ class LockableModelMethodsMixin(models.Model):
         return user == self.locked_by
 
     def save(self, *args, **kwargs):
-        if self.pk and self.lock_type == 'hard':
+        created = self.pk is None
+        if self._may_be_locked() and self._lock_unavailable():
+            raise ObjectLockedError("The lock store is unavailable, there may be a hard lock in place. You may not save.")
+        if self._may_be_locked() and self.lock_type == 'hard':
             raise ObjectLockedError("""There is currently a hard lock in place. You may not save.
             If you're requesting this save in order to unlock this object for the user who
             initiated the lock, make sure to call `unlock_for` first, with the user as
             the argument.""")
 
         super(LockableModelMethodsMixin, self).save(*args, **kwargs)
+        if created and self.lock_parent:
+            # Don't keep the parent's lock as read before the object existed
+            self._forget_lock()
 
 
 class LockableModel(LockableModelFieldsMixin, LockableModelMethodsMixin):
     class Meta:
         abstract = True
+
+
+class RowLockQuerySet(QuerySet):
+    """
+    Queryset on rows of a ``RowLockMixin`` model that takes the field names of
+    ``Lock`` (``locked_at``, ``token``...) for the lock columns, so that the
+    methods of ``LockableModelMethodsMixin`` work on rows as they do on locks.
+
+    ``delete`` and ``release`` release the locks, they don't delete the rows.
+    """
+    def _lock_lookups(self, kwargs):
+        lookups = {}
+        for lookup, value in kwargs.items():
+            parts = lookup.split('__', 1)
+            parts[0] = RowLock.fields.get(parts[0], parts[0])
+            lookups['__'.join(parts)] = value
+        return lookups
+
+    def filter(self, *args, **kwargs):
+        return super(RowLockQuerySet, self).filter(*args, **self._lock_lookups(kwargs))
+
+    def exclude(self, *args, **kwargs):
+        return super(RowLockQuerySet, self).exclude(*args, **self._lock_lookups(kwargs))
+
+    def update(self, **kwargs):
+        return super(RowLockQuerySet, self).update(**self._lock_lookups(kwargs))
+
+    def delete(self):
+        return self.release()
+
+    def release(self):
+        return self.update(locked_at=None, expires_at=None, locked_by=None,
+                           hard_lock=False, token='')
+
+
+class RowLock(object):
+    """
+    The lock stored in the row of a ``RowLockMixin`` object, with the
+    attributes and methods of a ``Lock``.
+    """
+    # Names of the attributes of a Lock, and of the row's fields they map to
+    fields = {
+        'locked_at': 'locking_locked_at',
+        'locked_by': 'locking_locked_by',
+        'locked_by_id': 'locking_locked_by_id',
+        'hard_lock': 'locking_hard_lock',
+        'expires_at': 'locking_expires_at',
+        'token': 'locking_token',
+    }
+
+    def __init__(self, obj):
+        self.__dict__.update(obj=obj, db_now=None)
+
+    def __getattr__(self, name):
+        if name in self.fields:
+            return getattr(self.obj, self.fields[name])
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in self.fields:
+            setattr(self.obj, self.fields[name], value)
+        elif name != 'pk':
+            self.__dict__[name] = value
+
+    @property
+    def pk(self):
+        return self.obj.pk
+
+    @property
+    def content_type_id(self):
+        return self.obj._lock_key()[0].pk
+
+    @property
+    def object_id(self):
+        return str(self.obj.pk)
+
+    def save(self):
+        if self.obj.pk is not None:
+            self.obj._lock_queryset().update(locked_at=self.locked_at,
+                expires_at=self.expires_at, locked_by=self.locked_by_id,
+                hard_lock=self.hard_lock, token=self.token)
+
+    def delete(self):
+        self.obj._lock_queryset().delete()
+        self.locked_at = self.expires_at = self.locked_by = None
+        self.hard_lock = False
+        self.token = ''
+
+
+class RowLockMixin(LockableModelMethodsMixin):
+    """
+    Alternative to ``LockableModelMethodsMixin`` that stores the lock of each
+    object in its own row, rather than in the ``Lock`` table: the lock comes
+    with the object, in the same SELECT, and taking or releasing it is a
+    conditional UPDATE of the row. The locking API is the same.
+
+    Row locks can't be used with ``lock_parent`` or ``lock_field_groups``,
+    and don't show up in ``Lock.objects`` or the ``Lock`` admin.
+
+    Saving an object reads its lock columns back from the database first, so
+    that the save doesn't overwrite a lock taken since the object was loaded.
+    """
+    class Meta:
+        abstract = True
+
+    locking_locked_at = models.DateTimeField(db_column='locked_at', null=True, editable=False)
+    locking_locked_by = models.ForeignKey(auth.User, db_column='locked_by', null=True,
+        editable=False, related_name='locking_%(app_label)s_%(class)s_set')
+    locking_hard_lock = models.BooleanField(db_column='hard_lock', default=False, editable=False)
+    locking_expires_at = models.DateTimeField(db_column='lock_expires_at', null=True,
+        db_index=True, editable=False)
+    locking_token = models.CharField(db_column='lock_token', max_length=32, blank=True,
+        db_index=True, editable=False)
+
+    @property
+    def lock(self):
+        if not hasattr(self, '_lock'):
+            if getattr(self, '_lock_stale', False):
+                self._reload_lock_columns()
+            self._lock = RowLock(self)
+        return self._lock
+
+    @lock.deleter
+    def lock(self):
+        # The lock columns may have been changed by an UPDATE, read them
+        # again when needed
+        del self._lock
+        self._lock_stale = True
+
+    def _forget_lock(self):
+        self.__dict__.pop('_lock', None)
+        self._lock_stale = True
+
+    def _reload_lock_columns(self):
+        names = [RowLock.fields[name] for name in ('locked_at', 'locked_by', 'hard_lock',
+                                                   'expires_at', 'token')]
+        rows = self.__class__._default_manager.filter(pk=self.pk).values(*names)
+        for values in rows:
+            for name, value in values.items():
+                setattr(self, self._meta.get_field(name).attname, value)
+            # Drop the cached user, locked_by may have changed
+            cache_name = self._meta.get_field('locking_locked_by').get_cache_name()
+            if hasattr(self, cache_name):
+                delattr(self, cache_name)
+        self._lock_stale = False
+
+    @property
+    def lock_info(self):
+        # The lock comes with the row, there's nothing to cache
+        if dbclock.is_enabled():
+            self._lock_now()
+        return LockInfo.from_lock(self.lock)
+
+    def _forget_lock_info(self):
+        pass
+
+    def _lock_database(self):
+        return router.db_for_write(self.__class__, instance=self)
+
+    def _lock_queryset(self, field_group=''):
+        return RowLockQuerySet(self.__class__).filter(pk=self.pk)
+
+    def _write_lock(self, user, changes, now):
+        if self.pk is None:
+            return
+        # Only take the lock if it's free or ours, in case it was taken since
+        # this object was loaded
+        available = models.Q(locking_expires_at__isnull=True) \
+            | models.Q(locking_expires_at__lte=now) | models.Q(locking_locked_by=user)
+        if not self._lock_queryset().filter(available).update(**changes):
+            del self.lock
+            self._record_event('conflict', user.pk)
+            raise ObjectLockedError("This object is already locked by another user. \
+                May not override, except through the `unlock` method.")
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None and not kwargs.get('force_insert'):
+            self._reload_lock_columns()
+            if hasattr(self, '_lock'):
+                del self._lock
+        super(RowLockMixin, self).save(*args, **kwargs)
+
+
+class RowLockableModel(LockableModelFieldsMixin, RowLockMixin):
+    class Meta:
+        abstract = True
+
+
+# Registry of all concrete lockable models, see ``utils.gather_lockable_models``
+lockable_models = []
+
+def register_lockable_model(sender, **kwargs):
+    if issubclass(sender, LockableModelMethodsMixin) and not sender._meta.proxy \
+            and sender not in lockable_models:
+        lockable_models.append(sender)
+
+class_prepared.connect(register_lockable_model,
+                       dispatch_uid='locking.models.register_lockable_model')
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers that push lock predicates into the SQL of querysets on lockable
+models, so that lists of objects can be filtered and sorted on their lock
+status without checking each object's lock in Python.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import models as auth
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.utils.datastructures import SortedDict
+
+from locking import clock, dbclock
+from locking.models import Lock, RowLock, RowLockMixin
+from locking.snapshots import LockInfo
+
+
+def _qn(name):
+    return connection.ops.quote_name(name)
+
+def _column(model, field_name):
+    return "%s.%s" % (_qn(model._meta.db_table),
+                      _qn(model._meta.get_field(field_name).column))
+
+def _lock_model(model):
+    # Objects covered by their parent's lock, see ``lock_parent``
+    if getattr(model, 'lock_parent', None):
+        return model._meta.get_field(model.lock_parent).rel.to
+    return model
+
+def _pk_column(model):
+    if getattr(model, 'lock_parent', None):
+        column = _column(model, model.lock_parent)
+    else:
+        column = "%s.%s" % (_qn(model._meta.db_table), _qn(model._meta.pk.column))
+    # Lock.object_id is a text column
+    if connection.vendor == 'postgresql':
+        column = "CAST(%s AS text)" % column
+    elif connection.vendor == 'mysql':
+        column = "CAST(%s AS char)" % column
+    return column
+
+def _is_row_lockable(model):
+    return issubclass(model, RowLockMixin)
+
+def _active_condition(model=Lock, fields=None):
+    """
+    Returns SQL and params for the condition on ``Lock`` rows (or the rows of
+    a ``RowLockMixin`` model, whose lock columns are given by ``fields``, see
+    ``RowLock.fields``) that are still active, evaluated against the
+    database's clock if ``use_database_clock`` is set (see
+    ``locking.dbclock``).
+
+    Rows from before ``expires_at`` was introduced are active while
+    ``locked_at`` is recent enough, as for ``LockableModel.is_locked``. The
+    condition is never NULL, so that it can be negated.
+    """
+    fields = fields or {}
+    expires_at = _column(model, fields.get('expires_at', 'expires_at'))
+    locked_at = _column(model, fields.get('locked_at', 'locked_at'))
+    condition = "((%s IS NOT NULL AND %s > %%s) OR (%s IS NULL AND %s IS NOT NULL AND %s > %%s))" \
+        % (expires_at, expires_at, expires_at, locked_at, locked_at)
+    expiration = settings.LOCKING['time_until_expiration']
+    if dbclock.is_enabled():
+        return condition % (dbclock.now_sql(), dbclock.ago_sql(expiration)), []
+    now = clock.now()
+    return condition % ('%s', '%s'), [now, now - timedelta(seconds=expiration)]
+
+def filter_active_locks(queryset):
+    """
+    Filters a queryset of ``Lock`` objects down to the active locks.
+    """
+    condition, params = _active_condition()
+    return queryset.extra(where=[condition], params=params)
+
+def _lock_where(model):
+    # Only whole-object locks, not field group locks
+    return "%s = %d AND %s = ''" % (_column(Lock, 'content_type'),
+        ContentType.objects.get_for_model(_lock_model(model)).pk,
+        _column(Lock, 'field_group'))
+
+def lock_column_sql(model, field_name):
+    """
+    Returns a correlated subquery selecting ``field_name`` from the lock of
+    each row of ``model``. ``field_name`` is a field of ``Lock``, or
+    ``username`` for the username of the lock owner.
+    """
+    if _is_row_lockable(model):
+        return _row_lock_column_sql(model, field_name)
+    table = _qn(Lock._meta.db_table)
+    if field_name == 'username':
+        column = _column(auth.User, 'username')
+        table = "%s INNER JOIN %s ON %s = %s" % (table,
+            _qn(auth.User._meta.db_table), _column(auth.User, 'id'),
+            _column(Lock, 'locked_by'))
+    else:
+        column = _column(Lock, field_name)
+    return "(SELECT %s FROM %s WHERE %s AND %s = %s)" % (column, table,
+        _lock_where(model), _column(Lock, 'object_id'), _pk_column(model))
+
+def _row_lock_column_sql(model, field_name):
+    # The lock is in the row itself, see ``RowLockMixin``
+    if field_name == 'username':
+        return "(SELECT %s FROM %s WHERE %s = %s)" % (_column(auth.User, 'username'),
+            _qn(auth.User._meta.db_table), _column(auth.User, 'id'),
+            _column(model, RowLock.fields['locked_by']))
+    return _column(model, RowLock.fields[field_name])
+
+def filter_by_lock(queryset, status, user=None):
+    """
+    Filters ``queryset`` on lock status, in SQL. ``status`` is one of
+    ``locked``, ``mine`` (locked by ``user``), ``others`` (locked by anybody
+    but ``user``) or ``free``.
+    """
+    model = queryset.model
+    if _is_row_lockable(model):
+        return _filter_by_row_lock(queryset, status, user)
+    condition, params = _active_condition()
+    conditions = [_lock_where(model), condition]
+    if status == 'mine':
+        conditions.append("%s = %%s" % _column(Lock, 'locked_by'))
+        params.append(user.pk)
+    elif status == 'others':
+        conditions.append("%s <> %%s" % _column(Lock, 'locked_by'))
+        params.append(user.pk)
+    active_locks = "SELECT %s FROM %s WHERE %s" % (_column(Lock, 'object_id'),
+        _qn(Lock._meta.db_table), " AND ".join(conditions))
+    operator = status == 'free' and 'NOT IN' or 'IN'
+    return queryset.extra(where=["%s %s (%s)" % (_pk_column(model), operator, active_locks)],
+                          params=params)
+
+def _filter_by_row_lock(queryset, status, user=None):
+    model = queryset.model
+    condition, params = _active_condition(model, RowLock.fields)
+    if status == 'free':
+        condition = "NOT %s" % condition
+    elif status == 'mine':
+        condition += " AND %s = %%s" % _column(model, RowLock.fields['locked_by'])
+        params.append(user.pk)
+    elif status == 'others':
+        condition += " AND %s <> %%s" % _column(model, RowLock.fields['locked_by'])
+        params.append(user.pk)
+    return queryset.extra(where=[condition], params=params)
+
+def with_lock_columns(queryset):
+    """
+    Adds the lock of each object to ``queryset``, as ``lock_locked_at``,
+    ``lock_locked_by``, ``lock_username``, ``lock_hard_lock`` and
+    ``lock_expires_at`` attributes, and the database's time as
+    ``lock_db_now`` with ``use_database_clock``.
+    ``lock_locked_at`` may be used to sort on lock age.
+    """
+    select = SortedDict()
+    for field_name in ('locked_at', 'locked_by', 'username', 'hard_lock', 'expires_at'):
+        select['lock_%s' % field_name] = lock_column_sql(queryset.model, field_name)
+    if dbclock.is_enabled():
+        # Lock status is computed from the database's time, see ``lock_info``
+        select['lock_db_now'] = dbclock.now_sql()
+    return queryset.extra(select=select)
+
+def lock_info(obj):
+    """
+    Returns a ``LockInfo`` for ``obj``, from the columns added by
+    ``with_lock_columns`` if they're there, from its ``Lock`` otherwise.
+    """
+    if not hasattr(obj, 'lock_locked_at'):
+        return obj.lock_info
+    ctype, object_id = obj._lock_key()
+    return LockInfo.from_row((ctype.pk, object_id, dbclock.parse(obj.lock_locked_at),
+                              obj.lock_locked_by, obj.lock_username, obj.lock_hard_lock,
+                              dbclock.parse(obj.lock_expires_at)),
+                             getattr(obj, 'lock_db_now', None))
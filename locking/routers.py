@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Lock reads and writes on a connection of their own, outside of the
+request's transaction.
+
+Within ``TransactionMiddleware`` or the admin's change view (which run in
+a transaction of the ``default`` database), an UPDATE of a ``Lock`` row
+keeps that row locked until the end of the request, and the heartbeats
+and lock checks of other users queue behind it. To have lock writes
+committed right away instead, add a second alias for the same database,
+which Django keeps in autocommit mode, and route locks to it::
+
+    DATABASES = {
+        'default': {...},
+        'locking': dict(DATABASES['default'], TEST_MIRROR='default'),
+    }
+    DATABASE_ROUTERS = ['locking.routers.LockRouter']
+    LOCKING = {..., 'database': 'locking'}
+
+Locks the request has taken are then visible to other requests before it
+ends, and aren't rolled back with it. The lock filters of
+``locking.queries`` keep reading the ``Lock`` table from the request's
+connection. Row locks (see ``RowLockMixin``) are in the object's row, and
+are still written in the request's transaction.
+
+The database needs row-level locking: on SQLite, which locks the whole
+file, lock writes on the second connection fail with "database is locked"
+while the request's transaction is writing (e.g. when ``LockableAdmin``
+releases the lock as it saves), so leave the alias out there.
+"""
+from django.conf import settings
+from django.db.utils import DEFAULT_DB_ALIAS
+
+
+def _is_lock(model):
+    # Don't import locking.models here, routers are loaded along with
+    # django.db
+    return model._meta.app_label == 'locking' and model._meta.object_name == 'Lock'
+
+
+class LockRouter(object):
+    """
+    Sends queries on ``Lock`` to the database alias of
+    ``LOCKING['database']``.
+    """
+    def db_for_read(self, model, **hints):
+        if _is_lock(model):
+            return settings.LOCKING.get('database')
+        return None
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Locks point to users and content types of the default alias, which
+        # is the same database
+        if _is_lock(obj1.__class__) or _is_lock(obj2.__class__):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        # The alias is another connection to a database that's synced
+        # through the default alias
+        alias = settings.LOCKING.get('database')
+        if alias and alias != DEFAULT_DB_ALIAS and db == alias:
+            return False
+        return None
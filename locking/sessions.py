@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Edit sessions: locks on several objects that are edited together (e.g. a
+story, its photos and its tags), owned by one session id.
+
+The session id is the lock token of every lock of the session, so that a
+single UPDATE extends all of them (one per model with ``RowLockMixin``, if
+any) and another one releases them.
+"""
+import uuid
+
+from django.contrib.contenttypes.models import ContentType
+
+from locking import signals, statuses
+from locking.models import Lock, ObjectLockedError, RowLockMixin, RowLockQuerySet, _now, _lease
+from locking.utils import gather_lockable_models
+
+
+def _lock_order(obj):
+    ctype, object_id = obj._lock_key()
+    return ctype.pk, str(object_id)
+
+
+class EditSession(object):
+    """
+    The locks ``user`` holds on a set of objects, identified by
+    ``session_id``. Pass the id of an existing session to refresh or release
+    it, e.g. in a later request.
+    """
+    def __init__(self, user, session_id=None):
+        self.user = user
+        self.session_id = session_id or uuid.uuid4().hex
+
+    def _querysets(self):
+        # The session's locks: in the Lock table, and in the rows of models
+        # that keep their own locks
+        yield Lock.objects.filter(token=self.session_id, locked_by=self.user)
+        for model in gather_lockable_models():
+            if issubclass(model, RowLockMixin):
+                yield RowLockQuerySet(model).filter(token=self.session_id, locked_by=self.user)
+
+    def acquire(self, objects, hard_lock=False, expires_in=None):
+        """
+        Locks all ``objects`` for the user, or none of them: raises
+        ``ObjectLockedError`` if any of them is locked by somebody else,
+        after releasing those it had locked already. Locks the user held
+        before (e.g. in another window) are given back their token and
+        expiry rather than released.
+
+        Objects are locked in a fixed order (by content type and object id)
+        so that sessions acquiring overlapping sets of objects can't
+        deadlock each other. Returns the session id.
+        """
+        locked = []
+        try:
+            for obj in sorted(objects, key=_lock_order):
+                lock = obj.lock
+                previous = None
+                if lock.locked_by_id == self.user.pk and obj.is_locked:
+                    previous = {'token': lock.token, 'locked_at': lock.locked_at,
+                                'expires_at': lock.expires_at, 'hard_lock': lock.hard_lock}
+                obj.lock_for(self.user, hard_lock=hard_lock, renew=True,
+                             expires_in=expires_in, token=self.session_id)
+                locked.append((obj, previous))
+        except ObjectLockedError:
+            for obj, previous in reversed(locked):
+                if previous is None:
+                    obj.unlock_for(self.user, token=self.session_id)
+                else:
+                    obj._lock_queryset().filter(token=self.session_id, locked_by=self.user) \
+                        .update(**previous)
+                    del obj.lock
+                    obj._forget_lock_info()
+            raise
+        return self.session_id
+
+    def refresh(self, expires_in=None):
+        """
+        Extends all locks of the session. Returns the number of locks that
+        were extended, 0 if the session has expired or was released. Locks
+        that have expired aren't extended: other users may have taken and
+        released them since.
+        """
+        now = _now()
+        count = 0
+        for locks in self._querysets():
+            locks = locks.filter(expires_at__gt=now)
+            count += locks.update(locked_at=now, expires_at=now + _lease(expires_in))
+            if locks.model is Lock and statuses.is_enabled():
+                # Cached snapshots would show the previous expiry dates
+                statuses.cache.forget(list(locks.values_list('content_type', 'object_id')))
+        return count
+
+    def release(self):
+        """
+        Releases all locks of the session.
+        """
+        for locks in self._querysets():
+            if locks.model is Lock:
+                keys = list(locks.values_list('content_type', 'object_id'))
+            else:
+                ctype = ContentType.objects.get_for_model(locks.model)
+                keys = [(ctype.pk, str(pk)) for pk in locks.values_list('pk', flat=True)]
+            locks.release()
+            if locks.model is Lock and statuses.is_enabled():
+                statuses.cache.forget(keys)
+            for content_type_id, object_id in keys:
+                signals.lock_released.send(sender=EditSession, content_type_id=content_type_id,
+                                           object_id=object_id)
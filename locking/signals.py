@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from django.dispatch import Signal
+
+# Sent whenever a lock is disengaged (through ``unlock`` or ``unlock_for``).
+# Receivers get the content type id and the object id of the unlocked object,
+# which is enough to wake up anyone waiting for that lock, be it in-process
+# (see ``locking.waiters``) or through a pub/sub of your own.
+lock_released = Signal(providing_args=["content_type_id", "object_id"])
+
+# Sent when the circuit breaker of the lock store trips, and when it recovers
+# (see ``locking.breaker``). Receivers get the number of failed or slow calls
+# that tripped it, and how long the store was considered down, respectively.
+lock_store_tripped = Signal(providing_args=["failures"])
+lock_store_recovered = Signal(providing_args=["downtime"])
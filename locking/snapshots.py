@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from locking import clock, dbclock
+
+
+def _clock_skew(db_now):
+    # The database's time minus the web server's, see ``locking.dbclock``
+    if db_now is None or not dbclock.is_enabled():
+        return None
+    return dbclock.parse(db_now) - clock.now()
+
+
+class LockInfo(object):
+    """
+    Immutable, lightweight snapshot of a lock.
+
+    Unlike a ``Lock`` instance it doesn't carry any model state, and it knows
+    the username of the lock owner without loading the ``User``. That makes it
+    cheap to build in bulk from ``values_list`` rows (see ``from_queryset``)
+    and to store in a cache.
+
+    With ``use_database_clock`` (see ``locking.dbclock``), snapshots keep the
+    difference between the database's time and the web server's as of when
+    they were read, ``clock_skew``, and compute their status from the
+    database's time.
+    """
+    attributes = ('content_type_id', 'object_id', 'locked_at', 'locked_by_id',
+                  'username', 'hard_lock', 'expires_at')
+    __slots__ = attributes + ('clock_skew',)
+
+    # Arguments to ``values_list`` that produce rows ``from_row`` understands.
+    fields = ('content_type', 'object_id', 'locked_at', 'locked_by',
+              'locked_by__username', 'hard_lock', 'expires_at')
+
+    def __init__(self, content_type_id, object_id, locked_at=None, locked_by_id=None,
+                 username=None, hard_lock=False, expires_at=None, clock_skew=None):
+        init = super(LockInfo, self).__setattr__
+        init('content_type_id', content_type_id)
+        init('object_id', str(object_id))
+        init('locked_at', locked_at)
+        init('locked_by_id', locked_by_id)
+        init('username', username)
+        init('hard_lock', bool(hard_lock))
+        init('expires_at', expires_at)
+        init('clock_skew', clock_skew)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("LockInfo objects are immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("LockInfo objects are immutable.")
+
+    @classmethod
+    def from_row(cls, row, db_now=None):
+        return cls(*row, clock_skew=_clock_skew(db_now))
+
+    @classmethod
+    def from_lock(cls, lock):
+        username = None
+        if lock.locked_by_id is not None:
+            username = lock.locked_by.username
+        return cls(lock.content_type_id, lock.object_id, lock.locked_at,
+                   lock.locked_by_id, username, lock.hard_lock, lock.expires_at,
+                   _clock_skew(getattr(lock, 'db_now', None)))
+
+    @classmethod
+    def from_queryset(cls, queryset):
+        """
+        Returns a snapshot for each ``Lock`` in ``queryset``, in one query.
+        """
+        if not dbclock.is_enabled():
+            return [cls.from_row(row) for row in queryset.values_list(*cls.fields)]
+        # Read the database's time along with the locks
+        rows = queryset.extra(select={'db_now': dbclock.now_sql()}) \
+            .values_list(*(cls.fields + ('db_now',)))
+        return [cls.from_row(row[:-1], row[-1]) for row in rows]
+
+    def as_tuple(self):
+        return tuple(getattr(self, name) for name in self.attributes)
+
+    def __reduce__(self):
+        return (self.__class__, self.as_tuple() + (self.clock_skew,))
+
+    def __eq__(self, other):
+        return isinstance(other, LockInfo) and self.as_tuple() == other.as_tuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.as_tuple())
+
+    def __repr__(self):
+        return "<LockInfo %s/%s by %s at %s>" % (self.content_type_id,
+            self.object_id, self.username, self.locked_at)
+
+    def _now(self):
+        if self.clock_skew is None:
+            return clock.now()
+        return clock.now() + self.clock_skew
+
+    @property
+    def is_locked(self):
+        """
+        See ``LockableModelMethodsMixin.is_locked``.
+        """
+        if isinstance(self.expires_at, datetime):
+            return self.expires_at > self._now()
+        if isinstance(self.locked_at, datetime):
+            return self.locked_at > self._now() - timedelta(seconds=settings.LOCKING['time_until_expiration'])
+        return False
+
+    @property
+    def lock_type(self):
+        if self.is_locked:
+            if self.hard_lock:
+                return "hard"
+            else:
+                return "soft"
+        else:
+            return None
+
+    @property
+    def lock_seconds_remaining(self):
+        if self.expires_at is not None:
+            return int((self.expires_at - self._now()).total_seconds())
+        return int(settings.LOCKING['time_until_expiration'] - (self._now() - self.locked_at).total_seconds())
+
+    def is_locked_by(self, user):
+        return getattr(user, 'pk', None) == self.locked_by_id
+
+    def lock_applies_to(self, user):
+        return self.is_locked and not self.is_locked_by(user)
@@ -15,6 +15,22 @@ var locking = locking || {};
 // Begin wrap.
 (function($, locking) {
 
+// Translations come with the script bundle (see locking/assets.py), falling
+// back on the catalog of a jsi18n view, if any.
+var catalog = window.locking_catalog || {};
+var gettext = function(msgid) {
+    if (catalog.hasOwnProperty(msgid)) return catalog[msgid];
+    return window.gettext ? window.gettext(msgid) : msgid;
+};
+var interpolate = window.interpolate || function(fmt, obj, named) {
+    if (named) {
+        return fmt.replace(/%\(\w+\)s/g, function(match) {
+            return String(obj[match.slice(2, -2)]);
+        });
+    }
+    return fmt.replace(/%s/g, function(match) { return String(obj.shift()); });
+};
+
 // Global error function that redirects to the frontpage if something bad
 // happens.
 locking.error = function() {
@@ -38,11 +54,12 @@ script, like the use of alert().
 Takes an array of arrays, each consisting of first the function to be delayed
 and second the delay in seconds. Must be ordered after delays descending.
 
-This is a one trick pony and must only be called once or bad things happens.
+Calling it again cancels the function calls that are still pending.
 */
 locking.delay_execution = function(funcs) {
     var self = this;
     var begin_time = new Date().getTime();
+    clearInterval(this.interval_id);
     var execute = function() {
         var current_time = new Date().getTime();
         var delay = funcs[0][1];
@@ -56,6 +73,55 @@ locking.delay_execution = function(funcs) {
     execute();
 };
 
+/*
+Message channel between the tabs and windows in which the same object is
+open, so that only one of them (the leader) holds the lock and talks to the
+server, while the others mirror its state.
+
+Uses BroadcastChannel where available, localStorage events otherwise.
+Without either, messages go nowhere and every tab acts on its own.
+*/
+locking.TabChannel = function(key) {
+    var self = this;
+    this.key = 'locking:' + key;
+    this.tab_id = Math.random().toString(36).slice(2);
+    this.handlers = [];
+    var receive = function(message) {
+        if (!message || message.tab === self.tab_id) return;
+        if (message.to && message.to !== self.tab_id) return;
+        $.each(self.handlers, function(i, handler) { handler(message); });
+    };
+    if (window.BroadcastChannel) {
+        this.channel = new BroadcastChannel(this.key);
+        this.channel.onmessage = function(e) { receive(e.data); };
+        this.post = function(message) { self.channel.postMessage(message); };
+    } else {
+        try {
+            window.localStorage.setItem(this.key, '');
+            $(window).bind('storage', function(e) {
+                e = e.originalEvent;
+                if (e.key === self.key && e.newValue) receive($.parseJSON(e.newValue));
+            });
+            this.post = function(message) {
+                // A unique value, so that every message triggers an event
+                message.nonce = Math.random();
+                window.localStorage.setItem(self.key, JSON.stringify(message));
+                window.localStorage.removeItem(self.key);
+            };
+        } catch(err) {
+            this.post = function() {};
+        }
+    }
+};
+
+locking.TabChannel.prototype.send = function(type, data) {
+    this.post($.extend({type: type, tab: this.tab_id}, data));
+};
+
+locking.TabChannel.prototype.on = function(handler) {
+    this.handlers.push(handler);
+};
+
 // Handles locking on the contrib.admin edit page.
 locking.admin = function() {
     // Needs a try/catch here as well because exceptions does not propagate
@@ -80,6 +146,13 @@ locking.admin = function() {
             unlock: base_url + "/unlock/",
             refresh_lock: base_url + "/refresh_lock/"
         };
+        // Other tabs and windows in which this object is open. While this
+        // tab holds the lock, it leads them; while another tab holds it, this
+        // tab follows.
+        var tabs = new locking.TabChannel(base_url);
+        var role = null;
+        var followers = [];
+        var expires_at = null;
         // Texts.
         var text = {
             warn: gettext('Your lock on this page expires in less than %s minutes. Press save or <a href=".">reload the page</a>.'),
@@ -90,6 +163,10 @@ locking.admin = function() {
             ),
             was_already_locked: gettext('It appears that you were already editing this page (maybe in another tab or window ?). If you think this is a mistake, you can choose to <a href="#force-release" class="force-release">force-release the lock</a>.'
             ),
+            in_other_tab: gettext('You are editing this page in another tab or window. Editing moves over to this one when you close the other.'
+            ),
+            released_elsewhere: gettext('This page was saved or closed in another tab or window. <a href=".">Reload the page</a> to edit it.'
+            ),
             prompt_to_save: 'Do you wish to save the page?',
         };
 
@@ -100,6 +177,8 @@ locking.admin = function() {
             ),
             locked_by_someone_else: gettext('%s is editing this object ! Before saving, you need to ask him/her to release the lock. Note that if he/she saves, conflicts may happen.'
             ),
+            lock_store_unavailable: gettext('Locks can\'t be checked at the moment, so this object can\'t be saved. Please try again in a little while.'
+            ),
         }
 
         // Creates empty span after change page title
@@ -189,14 +268,27 @@ locking.admin = function() {
         // The user did not save in time, expire the page.
         var expire_page = function() {
             update_notification_area(text.has_expired);
+            if (role === 'leader') tabs.send('expired');
+        };
+
+        // Token of the lock held by this window, if any.
+        var get_lock_token = function() {
+            return $('input[name="lock_token"]', change_form).val() || '';
         };
 
         var request_unlock = function() {
+            if (role === 'leader' && followers.length) {
+                // Hand the lock over to another tab rather than releasing it
+                tabs.send('handover', {to: followers[0], token: get_lock_token(),
+                                       expires_at: expires_at});
+                return;
+            }
             // We have to assure that our unlock request actually gets
             // through before the user leaves the page, so it shouldn't
             // run asynchronously.
             $.ajax({
                 url: urls.unlock,
+                data: {token: get_lock_token()},
                 async: false,
                 cache: false
             });
@@ -204,15 +296,23 @@ locking.admin = function() {
 
         var remove_ajax_unload = function() {
             $(window).unbind('beforeunload', request_unlock);
+            if (role === 'leader') tabs.send('released');
         }
 
-        var initialize_edit_mode = function() {
+        // Takes the lead of the other tabs, with a lock that expires in
+        // ``seconds`` (a fresh lock by default).
+        var initialize_edit_mode = function(seconds) {
+                if (seconds === undefined) seconds = settings.time_until_expiration;
                 notify_edit_mode();
+                role = 'leader';
+                expires_at = new Date().getTime() + seconds * 1000;
+                tabs.send('held', {expires_at: expires_at});
 
                 // Warn that lock will expire if he stays too long...
+                var warning = seconds - (settings.time_until_expiration - settings.time_until_warning);
                 locking.delay_execution([
-                    [display_warning, settings.time_until_warning],
-                    [expire_page, settings.time_until_expiration]
+                    [display_warning, Math.max(warning, 0)],
+                    [expire_page, seconds]
                 ]);
                 // Unlock page when user leaves the page without saving
                 $(window).bind('beforeunload', request_unlock);
@@ -229,6 +329,7 @@ locking.admin = function() {
                 } else if (jqXHR.status === 200) {
                     $('input[name="original_locked_at"]', change_form).attr("value", data.original_locked_at);
                     $('input[name="original_modified_at"]', change_form).attr("value", data.original_modified_at);
+                    $('input[name="lock_token"]', change_form).attr("value", data.lock_token);
                     if (force_save) {
                         $('input[type=submit][name=_continue]', change_form).click();
                     } else {
@@ -241,14 +342,118 @@ locking.admin = function() {
                     locking.error();
                 }
             };
+            var parse_refresh_lock_error = function(jqXHR) {
+                if (jqXHR.status === 409) {
+                    // Somebody else took the lock in the meantime
+                    disable_form();
+                    display_islocked($.parseJSON(jqXHR.responseText));
+                } else {
+                    locking.error();
+                }
+            };
             $.ajax({
                 url: urls.refresh_lock,
                 success: parse_refresh_lock_response,
                 cache: false,
-                error: locking.error
+                error: parse_refresh_lock_error
+            });
+        };
+
+        // Disables the fields of groups locked by somebody else.
+        var disable_fields = function(names) {
+            $.each(names, function(i, name) {
+                $(':input[name="' + name + '"]', change_form).attr("disabled", "disabled");
+            });
+        };
+
+        // Asks for the lock on a group of fields as soon as the user starts
+        // editing one of its fields.
+        var acquire_field_groups_on_input = function() {
+            var groups = locking.infos.field_groups.field_groups;
+            var acquired = {};
+            $(":input", change_form).bind('keydown.locking change.locking', function() {
+                var group = groups[this.name];
+                if (!group || acquired[group]) return;
+                acquired[group] = true;
+                $.ajax({
+                    url: urls.refresh_lock,
+                    data: {field_group: group},
+                    cache: false,
+                    success: function() {
+                        $(window).unbind('beforeunload', request_unlock)
+                                 .bind('beforeunload', request_unlock);
+                        change_form.bind('submit', remove_ajax_unload);
+                    },
+                    error: function(jqXHR) {
+                        if (jqXHR.status === 409) {
+                            var fields = [];
+                            $.each(groups, function(field, field_group) {
+                                if (field_group === group) fields.push(field);
+                            });
+                            disable_fields(fields);
+                        } else {
+                            locking.error();
+                        }
+                    }
+                });
+            });
+        };
+
+        // Asks for the lock as soon as the user starts editing.
+        var acquire_on_first_input = function() {
+            var acquire = function() {
+                $(":input", change_form).unbind('.locking');
+                request_refresh_lock();
+            };
+            $(":input", change_form).bind('keydown.locking change.locking', acquire);
+        };
+
+        // Asks whether another tab holds the lock, and follows it if so.
+        var follow_other_tab = function(not_found) {
+            var answered = false;
+            tabs.on(function(message) {
+                if (message.type === 'held' && !answered) {
+                    answered = true;
+                    role = 'follower';
+                    update_notification_area(text.in_other_tab);
+                }
             });
+            tabs.send('query');
+            setTimeout(function() {
+                if (!answered) {
+                    answered = true;
+                    not_found();
+                }
+            }, 500);
         };
 
+        tabs.on(function(message) {
+            if (message.type === 'query' && role === 'leader') {
+                if ($.inArray(message.tab, followers) === -1) followers.push(message.tab);
+                tabs.send('held', {to: message.tab, expires_at: expires_at});
+            } else if (message.type === 'gone') {
+                followers = $.grep(followers, function(tab) { return tab !== message.tab; });
+            } else if (role !== 'follower') {
+                return;
+            } else if (message.type === 'held' && !message.to) {
+                // A new leader, let it know about this tab
+                tabs.send('query');
+            } else if (message.type === 'handover') {
+                $('input[name="lock_token"]', change_form).attr("value", message.token);
+                enable_form();
+                initialize_edit_mode((message.expires_at - new Date().getTime()) / 1000);
+            } else if (message.type === 'released') {
+                role = null;
+                update_notification_area(text.released_elsewhere);
+            } else if (message.type === 'expired') {
+                role = null;
+                update_notification_area(text.has_expired);
+            }
+        });
+        $(window).bind('beforeunload', function() {
+            if (role === 'follower') tabs.send('gone');
+        });
+
         // Analyse locking_info and disable form if necessary
         var lock_if_necessary = function() {
             if (locking.infos.is_POST_response && locking.infos.error_when_saving) {
@@ -267,15 +472,38 @@ locking.admin = function() {
                 // An active lock by this user was found when loading the page.
                 // Disable form, warn him and allow him to ignore the old lock
                 disable_form();
-                $('body').delegate('a.force-release', 'click', function(e) {
-                    request_refresh_lock();
-                    return false;
+                follow_other_tab(function() {
+                    // No other tab has it, the lock was left behind
+                    $('body').delegate('a.force-release', 'click', function(e) {
+                        request_refresh_lock();
+                        return false;
+                    });
+                    display_wasalreadylocked(locking.infos);
                 });
-                display_wasalreadylocked(locking.infos);
+            }
+            else if (locking.infos.applies && locking.infos.read_only) {
+                // The server rendered the form read-only, only the buttons
+                // are left to disable
+                $(":submit", change_form).attr("disabled", "disabled");
+                change_form.addClass('disabled');
+                display_islocked(locking.infos);
             }
             else if (locking.infos.applies) {
                 disable_form();
                 display_islocked(locking.infos);
+            } else if (locking.infos.field_groups) {
+                // only some groups of fields may be locked by others
+                enable_form();
+                disable_fields(locking.infos.field_groups.locked_fields);
+                if (locking.infos.lazy_acquire) {
+                    acquire_field_groups_on_input();
+                } else {
+                    initialize_edit_mode();
+                }
+            } else if (locking.infos.lazy_acquire && !locking.infos.is_active) {
+                // page is not locked yet, lock it once the user edits it
+                enable_form();
+                acquire_on_first_input();
             } else { // page is not locked for user
                 enable_form();
                 initialize_edit_mode();
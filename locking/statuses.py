@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+A read-through cache of lock snapshots (``LockInfo``), for the reads that
+only display lock status: changelist badges, status polls of ``LockView``,
+``lock_info``.
+
+Enable it with ``LOCKING['status_cache']``, the alias of the cache to use
+(see ``CACHES``). Snapshots are kept for ``LOCKING['status_cache_timeout']``
+seconds (60 by default). Lock writes of this app invalidate the cached
+snapshot rather than replace it, so that a write that is rolled back doesn't
+leave its lock in the cache. Snapshots are stored along with the generation
+of their object, which invalidation moves on: a process that read the lock
+before a write can only store it under the previous generation, which
+readers ignore. Writes made within a transaction (e.g. in
+``TransactionMiddleware``, unless locks have a connection of their own, see
+``locking.routers``) are invalidated again at the end of the request, once
+committed, in case a status read refilled the cache with the lock as it was
+before. Locks that expire don't need to be invalidated: snapshots compute
+their status from their expiry date. Writes made outside of the locking API
+(e.g. raw SQL) are only seen once the snapshot times out.
+
+On a miss, a single process fetches the lock while the others wait for it
+for up to ``LOCKING['status_cache_wait']`` seconds (0.5 by default), then
+fall back to fetching it themselves, so that a popular object doesn't send a
+burst of identical queries to the database.
+
+Checks that decide whether a lock may be taken or a form saved
+(``lock_for``, ``LockableForm.clean``...) always read the ``Lock`` table.
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.signals import request_finished
+from django.db import router, transaction
+
+# Lifetime of the marker of a process filling a snapshot, in case it dies
+FILL_TIMEOUT = 5
+# Lifetime of generations, well beyond the one of snapshots so that they're
+# not started over while their snapshots are still cached
+GENERATION_TIMEOUT = 24 * 3600
+POLL_INTERVAL = 0.05
+
+
+def is_enabled():
+    return settings.LOCKING.get('status_cache') is not None
+
+
+def _key(content_type_id, object_id):
+    object_id = str(object_id)
+    if not object_id.isdigit():
+        # Keep keys short and free of characters memcached doesn't allow
+        object_id = hashlib.md5(object_id).hexdigest()
+    return 'locking.status.%d.%s' % (content_type_id, object_id)
+
+
+class StatusCache(object):
+    @property
+    def backend(self):
+        return get_cache(settings.LOCKING['status_cache'])
+
+    @property
+    def timeout(self):
+        return settings.LOCKING.get('status_cache_timeout', 60)
+
+    def _lookup(self, key):
+        # The current generation of a snapshot, and the snapshot if it's of
+        # that generation, in a single round trip
+        cache = self.backend
+        values = cache.get_many([key, key + '.gen'])
+        generation = values.get(key + '.gen')
+        if generation is None:
+            # Never reuse the generation of a key that was evicted
+            cache.add(key + '.gen', int(time.time() * 1000), GENERATION_TIMEOUT)
+            return cache.get(key + '.gen'), None
+        if key in values and values[key][0] == generation:
+            return generation, values[key][1]
+        return generation, None
+
+    def get(self, content_type_id, object_id, fetch):
+        """
+        Returns the snapshot of the lock on an object, from the cache or from
+        ``fetch``, a function that reads it from the lock store.
+        """
+        cache = self.backend
+        key = _key(content_type_id, object_id)
+        generation, info = self._lookup(key)
+        if info is not None:
+            return info
+        fill_key = '%s.%s.fill' % (key, generation)
+        if cache.add(fill_key, True, FILL_TIMEOUT):
+            try:
+                info = fetch()
+                cache.set(key, (generation, info), self.timeout)
+            finally:
+                cache.delete(fill_key)
+            return info
+        # Somebody else is fetching it, give them a moment
+        deadline = time.time() + settings.LOCKING.get('status_cache_wait', 0.5)
+        while time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+            info = self._lookup(key)[1]
+            if info is not None:
+                return info
+        return fetch()
+
+    def forget(self, keys):
+        """
+        Invalidates the snapshots of the locks of ``keys``, a list of content
+        type id and object id pairs, after they've been written.
+        """
+        from locking.models import Lock
+
+        self._invalidate(keys)
+        if transaction.is_managed(using=router.db_for_write(Lock)):
+            # Not committed yet, see forget_pending
+            if not hasattr(_pending, 'keys'):
+                _pending.keys = set()
+            _pending.keys.update((content_type_id, str(object_id))
+                                 for content_type_id, object_id in keys)
+
+    def forget_pending(self):
+        """
+        Invalidates again the snapshots of the locks written within a
+        transaction by this thread, now that it's over.
+        """
+        keys = getattr(_pending, 'keys', None)
+        if keys:
+            _pending.keys = set()
+            if is_enabled():
+                self._invalidate(keys)
+
+    def _invalidate(self, keys):
+        cache = self.backend
+        for content_type_id, object_id in keys:
+            key = _key(content_type_id, object_id) + '.gen'
+            try:
+                cache.incr(key)
+            except ValueError:
+                # Not cached, the next read starts a new generation
+                pass
+
+cache = StatusCache()
+
+# Keys written within a transaction, per thread
+_pending = threading.local()
+
+
+def forget_pending(sender, **kwargs):
+    cache.forget_pending()
+
+request_finished.connect(forget_pending, dispatch_uid='locking.statuses.forget_pending')
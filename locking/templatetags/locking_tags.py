@@ -25,19 +25,28 @@ def locking_variables(context):
         # (disable form, display "is locked" message, etc.) at the client level
         original = context['original']
         request = context['request']
+        model_form  = context['adminform'].form
         is_POST_response = request.method == 'POST'
+        locked_by = original.locked_by
+        # Already known when LockableAdmin renders the form read-only
+        applies = getattr(request, '_locking_applies', None)
+        if applies is None:
+            applies = original.lock_applies_to(request.user)
         locking_infos = {
             "is_active": original.is_locked,
-            "for_user": escape(original.locked_by.get_full_name()),
-            "applies": original.lock_applies_to(request.user),
+            "for_user": locked_by and escape(locked_by.get_full_name()) or '',
+            "applies": applies,
+            # Rendered read-only by LockableAdmin, nothing to disable
+            "read_only": getattr(request, '_locking_read_only', False),
             "change_form_id": "%s_form" % (original._meta.module_name,),
             "was_already_locked_by_user": getattr(original, '_was_already_locked_by_user', False),
             "is_POST_response": is_POST_response,
             "error_when_saving": None,
+            "lazy_acquire": getattr(model_form, 'is_lazy_acquire', lambda: False)(),
+            "field_groups": getattr(model_form, 'field_group_infos', lambda: None)(),
             "change": True
         }
         # If we are responding after a POST, export locking errors if any
-        model_form  = context['adminform'].form
         if is_POST_response:
             locking_infos["error_when_saving"] = getattr(model_form, '_locking_error_when_saving', None)
 
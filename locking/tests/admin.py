@@ -15,6 +15,12 @@ class StoryAdmin(LockableAdmin):
 admin.site.register(models.Story, StoryAdmin)
 
 
+class ArticleAdmin(LockableAdmin):
+    form = forms.ArticleAdminForm
+
+admin.site.register(models.Article, ArticleAdmin)
+
+
 class UnlockableAdmin(admin.ModelAdmin):
     pass
 
@@ -7,3 +7,7 @@ import models
 class StoryAdminForm(LockableForm):
     class Meta:
         model = models.Story
+
+class ArticleAdminForm(LockableForm):
+    class Meta:
+        model = models.Article
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Load test for the locking layer: a number of simulated editors, each in its
+own thread with its own ``django.test.Client``, work concurrently on a few
+``Story`` objects through the ``LockableAdmin`` views.
+
+Each round, an editor opens the change form of a random story (which locks
+it), sends a few heartbeats to ``refresh_lock_view``, and then either saves
+its changes or closes the page through ``unlock_view``. Every save appends a
+unique marker to the story, so that saves that were overwritten by somebody
+else (lost updates) can be counted afterwards.
+
+Run it through ``manage.py locking_loadtest``.
+"""
+from HTMLParser import HTMLParser
+import math
+import random
+import re
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+
+from locking.tests.models import Story
+
+token_re = re.compile(r'name="lock_token" value="([0-9a-f]*)"')
+content_re = re.compile(r'<textarea[^>]*name="content"[^>]*>(.*?)</textarea>', re.S)
+unescape = HTMLParser().unescape
+
+
+def percentile(values, percent):
+    # Nearest rank: the smallest value that ``percent`` of the values are
+    # less than or equal to
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+
+class Editor(threading.Thread):
+    def __init__(self, loadtest, number):
+        super(Editor, self).__init__(name='editor-%d' % number)
+        self.loadtest = loadtest
+        self.username = 'editor%d' % number
+        self.client = Client()
+        self.timings = {}
+        self.opened = self.conflicts = self.saved = self.errors = 0
+        self.markers = []
+
+    def request(self, view, method, url, data=None):
+        start = time.time()
+        try:
+            response = getattr(self.client, method)(url, data or {})
+        except Exception:
+            self.errors += 1
+            return None
+        finally:
+            self.timings.setdefault(view, []).append(time.time() - start)
+        return response
+
+    def run(self):
+        try:
+            self.client.login(username=self.username, password=self.username)
+            for round in range(self.loadtest.rounds):
+                self.edit(random.choice(self.loadtest.story_ids), round)
+                time.sleep(self.loadtest.think_time)
+        finally:
+            connection.close()
+
+    def edit(self, story_id, round):
+        urls = self.loadtest.urls(story_id)
+        response = self.request('change_form', 'get', urls['change'])
+        if response is None or response.status_code != 200:
+            return
+        self.opened += 1
+        match = token_re.search(response.content)
+        if not match or not match.group(1):
+            # Somebody else is editing this story
+            self.conflicts += 1
+            return
+        token = match.group(1)
+        content = unescape(content_re.search(response.content).group(1).decode('utf-8'))
+
+        for heartbeat in range(self.loadtest.heartbeats):
+            time.sleep(self.loadtest.think_time)
+            response = self.request('refresh_lock', 'get', urls['refresh_lock'], {'token': token})
+            if response is not None and response.status_code == 409:
+                self.conflicts += 1
+                return
+
+        if random.random() < self.loadtest.save_ratio:
+            marker = '[%s-%d]' % (self.username, round)
+            response = self.request('save', 'post', urls['change'], {
+                'content': content + marker,
+                'lock_token': token,
+            })
+            if response is not None and response.status_code == 302:
+                self.saved += 1
+                self.markers.append((story_id, marker))
+            elif response is not None:
+                self.conflicts += 1
+        else:
+            self.request('unlock', 'get', urls['unlock'], {'token': token})
+
+
+class LoadTest(object):
+    def __init__(self, editors=10, stories=3, rounds=10, heartbeats=2,
+                 save_ratio=0.5, think_time=0.01):
+        self.editor_count = editors
+        self.story_count = stories
+        self.rounds = rounds
+        self.heartbeats = heartbeats
+        self.save_ratio = save_ratio
+        self.think_time = think_time
+
+    def urls(self, story_id):
+        return {
+            'change': reverse('admin:tests_story_change', args=[story_id]),
+            'refresh_lock': reverse('admin:refresh_lock_tests_story', args=[story_id]),
+            'unlock': reverse('admin:unlock_tests_story', args=[story_id]),
+        }
+
+    def setup(self):
+        self.story_ids = [Story.objects.create(content='').pk
+                          for i in range(self.story_count)]
+        for i in range(self.editor_count):
+            username = 'editor%d' % i
+            User.objects.create_superuser(username, '%s@example.com' % username, username)
+
+    def run(self):
+        """
+        Runs the load test and returns a report, as a dict.
+        """
+        self.setup()
+        editors = [Editor(self, i) for i in range(self.editor_count)]
+        start = time.time()
+        for editor in editors:
+            editor.start()
+        for editor in editors:
+            editor.join()
+        duration = time.time() - start
+        return self.report(editors, duration)
+
+    def report(self, editors, duration):
+        timings = {}
+        for editor in editors:
+            for view, values in editor.timings.items():
+                timings.setdefault(view, []).extend(values)
+        all_timings = sum(timings.values(), [])
+
+        contents = dict(Story.objects.values_list('pk', 'content'))
+        markers = sum([editor.markers for editor in editors], [])
+        lost_updates = len([marker for story_id, marker in markers
+                            if marker not in contents[story_id]])
+        opened = sum(editor.opened for editor in editors)
+        conflicts = sum(editor.conflicts for editor in editors)
+
+        return {
+            'duration': duration,
+            'requests': len(all_timings),
+            'throughput': len(all_timings) / duration,
+            'latency': dict((view, {
+                'p50': percentile(values, 50),
+                'p99': percentile(values, 99),
+            }) for view, values in timings.items() + [('all', all_timings)]),
+            'opened': opened,
+            'conflicts': conflicts,
+            'conflict_rate': opened and float(conflicts) / opened or 0.0,
+            'saved': len(markers),
+            'lost_updates': lost_updates,
+            'errors': sum(editor.errors for editor in editors),
+        }
@@ -12,6 +12,30 @@ class Story(locking_models.LockableModel):
         verbose_name_plural = 'stories'
 
 
+class Article(locking_models.LockableModel):
+    # metadata and body of an article may be edited by different users
+    title = models.CharField(max_length=200, blank=True)
+    content = models.TextField(blank=True)
+
+    lock_field_groups = {
+        'metadata': ('title',),
+        'body': ('content',),
+    }
+
+
+class Paragraph(locking_models.LockableModelMethodsMixin):
+    # paragraphs are covered by the lock of their story
+    story = models.ForeignKey(Story, related_name='paragraphs')
+    content = models.TextField(blank=True)
+
+    lock_parent = 'story'
+
+
+class Note(locking_models.RowLockableModel):
+    # notes keep their lock in their own row
+    content = models.TextField(blank=True)
+
+
 class Unlockable(models.Model):
     # this model serves to test that utils.gather_lockable_models
     # actually does what it's supposed to
@@ -1,19 +1,41 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime, timedelta
+import pickle
 import simplejson
+from StringIO import StringIO
 
 from django.conf import settings
+from django.core.management import call_command
+from django.core.signals import request_finished
 from django.core.urlresolvers import reverse
+from django.db import connection, connections, router, transaction
+from django.http import Http404, HttpResponse
 from django.template import RequestContext
 from django.template.base import Template
-from django.test.client import Client
-from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+from django.utils import unittest
+from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.contenttypes.models import ContentType
 
 from locking import time_until_expiration, models
+from locking import assets, breaker, clock, dbclock, history, inventory, queries, routers, signals, statuses, views
+from locking.admin import LockAdmin
+from locking.middleware import LockCostMiddleware
+from locking.sessions import EditSession
+from locking.templatetags import locking_tags
+from locking.snapshots import LockInfo
+from locking.utils import gather_lockable_models
+from locking.views import LockView
+from locking.waiters import waiters
 
 from utils import TestCase
-from models import Story, Unlockable
+from models import Article, Note, Paragraph, Story, Unlockable
+import forms as test_forms
+import views as test_views
 
 
 class BaseTestCase(TestCase):
@@ -87,6 +109,748 @@ class AppTestCase(BaseTestCase):
         self.story.locked_at = datetime.now() - timedelta(seconds=time_until_expiration + 1)
         self.assertFalse(self.story.is_locked)
 
+    def test_manual_clock(self):
+        manual = clock.ManualClock()
+        previous = clock.install(manual)
+        try:
+            self.story.lock_for(self.user)
+            self.assertEquals(self.story.lock_seconds_remaining, time_until_expiration)
+            manual.advance(time_until_expiration - 1)
+            self.assertTrue(Story.objects.get(pk=self.story.pk).is_locked)
+            self.assertTrue(self.story.lock_info.is_locked)
+            self.assertEquals(models.Lock.objects.expired().count(), 0)
+            manual.advance(1)
+            self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+            self.assertFalse(self.story.lock_info.is_locked)
+            self.assertEquals(models.Lock.objects.expired().count(), 1)
+            self.assertEquals(queries.filter_by_lock(Story.objects.all(), 'free').count(), 2)
+            # hours of churn, without sleeping
+            for i in range(100):
+                self.story.lock_for(self.user if i % 2 else self.alt_user)
+                manual.advance(time_until_expiration)
+            self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+        finally:
+            clock.install(previous)
+
+    def test_lock_expires_in(self):
+        self.story.lock_for(self.user, expires_in=60)
+        self.assertTrue(time_until_expiration < self.story.lock_seconds_remaining <= 60)
+        self.assertTrue(self.story.refresh_lock(self.story.lock.token, expires_in=120))
+        self.assertTrue(30 < self.story.lock_seconds_remaining <= 120)
+
+    def test_lock_manager(self):
+        self.story.lock_for(self.user, expires_in=300)
+        self.alt_story.lock_for(self.alt_user, expires_in=10)
+        Lock = models.Lock
+        self.assertEquals(Lock.objects.active().count(), 2)
+        self.assertEquals(Lock.objects.expired().count(), 0)
+        self.assertEquals([lock.object_id for lock in Lock.objects.expiring_soon(60)],
+                          [str(self.alt_story.pk)])
+        Lock.objects.filter(object_id=self.alt_story.pk) \
+            .update(expires_at=datetime.now() - timedelta(seconds=1))
+        self.assertEquals(Lock.objects.active().count(), 1)
+        self.assertEquals(Lock.objects.expired().count(), 1)
+        Lock.objects.sweep()
+        self.assertEquals(Lock.objects.count(), 1)
+
+    def test_acquire(self):
+        self.story.acquire(self.user, timeout=0)
+        self.assertTrue(self.story.is_locked_by(self.user))
+
+    def test_acquire_timeout(self):
+        self.story.lock_for(self.alt_user)
+        self.assertRaises(models.ObjectLockedError, self.story.acquire, self.user,
+                          timeout=0.1, poll=0.05)
+        self.assertEquals(len(waiters), 0)
+
+    def test_unlock_notifies_waiters_in_order(self):
+        self.story.lock_for(self.user)
+        key = (ContentType.objects.get_for_model(Story).pk, str(self.story.pk))
+        first = waiters.enqueue(key)
+        second = waiters.enqueue(key)
+        first.clear()
+        self.story.unlock()
+        self.assertTrue(first.is_set())
+        self.assertFalse(second.is_set())
+        waiters.remove(key, first)
+        self.assertTrue(second.is_set())
+        waiters.remove(key, second)
+
+    def test_lock_token(self):
+        token = self.story.lock_for(self.user)
+        self.assertTrue(token)
+        self.assertTrue(self.story.refresh_lock(token))
+        self.assertFalse(self.story.refresh_lock('not-the-token'))
+        self.assertNotEquals(self.story.lock_for(self.user), token)
+        self.assertFalse(self.story.refresh_lock(token))
+
+    def test_unlock_for_token_deletes_lock(self):
+        token = self.story.lock_for(self.user)
+        self.assertRaises(models.ObjectLockedError, self.story.unlock_for, self.user, 'not-the-token')
+        self.assertRaises(models.ObjectLockedError, self.story.unlock_for, self.alt_user, token)
+        self.story.unlock_for(self.user, token)
+        self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+        self.assertFalse(models.Lock.objects.filter(object_id=str(self.story.pk)).exists())
+
+    def test_lock_release(self):
+        token = self.story.lock_for(self.user)
+        self.alt_story.lock_for(self.user)
+        locks = models.Lock.objects.filter(token=token, locked_by=self.user)
+        self.assertEquals(models.Lock.objects.filter(token=token, locked_by=self.alt_user).release(), 0)
+        self.assertEquals(locks.release(), 1)
+        self.assertEquals(locks.release(), 0)
+        self.assertEquals([lock.object_id for lock in models.Lock.objects.all()],
+                          [str(self.alt_story.pk)])
+
+    def test_lock_for_coalesced(self):
+        settings.LOCKING['min_refresh_interval'] = 10
+        try:
+            token = self.story.lock_for(self.user)
+            with self.assertNumQueries(0):
+                self.assertEquals(self.story.lock_for(self.user), token)
+            # a longer lease is written
+            with self.assertNumQueries(1):
+                self.assertNotEquals(self.story.lock_for(self.user, expires_in=60), token)
+            self.assertNotEquals(self.story.lock_for(self.user, hard_lock=True), token)
+            self.assertNotEquals(self.story.lock_for(self.user, hard_lock=True, renew=True), token)
+        finally:
+            del settings.LOCKING['min_refresh_interval']
+
+    def test_lock_for_updates_changed_columns(self):
+        self.story.lock_for(self.user)
+        with self.assertNumQueries(1):
+            self.story.lock_for(self.user)
+        self.assertTrue(Story.objects.get(pk=self.story.pk).is_locked_by(self.user))
+
+    def test_refresh_lock_coalesced(self):
+        token = self.story.lock_for(self.user)
+        locked_at = self.story.locked_at
+        settings.LOCKING['min_refresh_interval'] = 10
+        try:
+            self.assertTrue(self.story.refresh_lock(token))
+            self.assertFalse(self.story.refresh_lock('not-the-token'))
+            self.assertEquals(Story.objects.get(pk=self.story.pk).locked_at, locked_at)
+            # a longer lease is written
+            self.assertTrue(self.story.refresh_lock(token, expires_in=60))
+            story = Story.objects.get(pk=self.story.pk)
+            self.assertTrue(story.lock_seconds_remaining > time_until_expiration)
+        finally:
+            del settings.LOCKING['min_refresh_interval']
+
+    def test_refresh_lock_coalesced_expired(self):
+        token = self.story.lock_for(self.user, expires_in=1)
+        settings.LOCKING['min_refresh_interval'] = 10
+        try:
+            models.Lock.objects.update(expires_at=datetime.now() - timedelta(seconds=1))
+            story = Story.objects.get(pk=self.story.pk)
+            # the lock no longer covers the lease, the refresh is written
+            self.assertTrue(story.refresh_lock(token))
+            story = Story.objects.get(pk=self.story.pk)
+            self.assertTrue(story.is_locked)
+            self.assertEquals(story.lock.token, token)
+        finally:
+            del settings.LOCKING['min_refresh_interval']
+
+    def test_unlock_for_token(self):
+        token = self.story.lock_for(self.user)
+        new_token = self.story.lock_for(self.user)
+        self.assertRaises(models.ObjectLockedError, self.story.unlock_for, self.user, token)
+        self.story.unlock_for(self.user, new_token)
+        self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+
+    def test_lock_info(self):
+        self.story.lock_for(self.alt_user, hard_lock=True)
+        info = self.story.lock_info
+        self.assertEquals(info.username, self.alt_user.username)
+        self.assertEquals(info.lock_type, "hard")
+        self.assertTrue(info.lock_applies_to(self.user))
+        self.assertFalse(info.lock_applies_to(self.alt_user))
+        self.assertRaises(AttributeError, setattr, info, 'hard_lock', False)
+        self.assertEquals(pickle.loads(pickle.dumps(info)), info)
+
+    def test_lock_info_from_queryset(self):
+        self.story.lock_for(self.user)
+        self.alt_story.lock_for(self.alt_user)
+        infos = LockInfo.from_queryset(models.Lock.objects.order_by('object_id'))
+        self.assertEquals(infos, [self.alt_story.lock_info, self.story.lock_info])
+
+    def test_status_cache(self):
+        settings.LOCKING['status_cache'] = 'default'
+        statuses.cache.backend.clear()
+        try:
+            self.assertFalse(Story.objects.get(pk=self.story.pk).lock_info.is_locked)
+            with self.assertNumQueries(0):
+                self.assertFalse(Story(pk=self.story.pk).lock_info.is_locked)
+
+            # lock writes invalidate the cached snapshot
+            token = self.story.lock_for(self.alt_user)
+            with self.assertNumQueries(1):
+                info = Story(pk=self.story.pk).lock_info
+            with self.assertNumQueries(0):
+                self.assertEquals(Story(pk=self.story.pk).lock_info, info)
+            self.assertEquals(info.username, self.alt_user.username)
+            self.assertTrue(info.lock_applies_to(self.user))
+            self.assertTrue(Story(pk=self.story.pk).refresh_lock(token))
+            with self.assertNumQueries(1):
+                self.assertTrue(Story(pk=self.story.pk).lock_info.is_locked)
+            self.story.unlock_for(self.alt_user, token=token)
+            with self.assertNumQueries(1):
+                self.assertFalse(Story(pk=self.story.pk).lock_info.is_locked)
+
+            # a snapshot read before a write isn't cached after it
+            ctype = ContentType.objects.get_for_model(Story)
+            def fetch():
+                info = LockInfo(ctype.pk, str(self.story.pk))
+                Story(pk=self.story.pk).lock_for(self.user)
+                return info
+            statuses.cache.backend.delete(statuses._key(ctype.pk, self.story.pk))
+            self.assertFalse(statuses.cache.get(ctype.pk, self.story.pk, fetch).is_locked)
+            self.assertTrue(Story(pk=self.story.pk).lock_info.is_locked)
+
+            # nor is one read before the write's transaction is committed,
+            # once the request is over
+            self.story.unlock()
+            self.story.lock_for(self.user)
+            statuses.cache.get(ctype.pk, self.story.pk, lambda: LockInfo(ctype.pk, str(self.story.pk)))
+            request_finished.send(sender=self.__class__)
+            self.assertTrue(Story(pk=self.story.pk).lock_info.is_locked)
+
+            # authoritative checks don't use the cache
+            models.Lock.objects.all().delete()
+            self.alt_story.lock_for(self.user)
+            session = EditSession(self.user)
+            session.acquire([self.story])
+            # a stale snapshot
+            statuses.cache.get(ctype.pk, self.story.pk, lambda: LockInfo(ctype.pk, str(self.story.pk)))
+            self.assertFalse(Story(pk=self.story.pk).lock_info.is_locked)
+            self.assertTrue(Story(pk=self.story.pk).is_locked)
+            self.assertRaises(models.ObjectLockedError, Story(pk=self.story.pk).lock_for, self.alt_user)
+            session.release()
+            self.assertFalse(Story(pk=self.story.pk).lock_info.is_locked)
+        finally:
+            del settings.LOCKING['status_cache']
+
+    def test_status_cache_stampede(self):
+        settings.LOCKING.update(status_cache='default', status_cache_wait=0)
+        statuses.cache.backend.clear()
+        try:
+            self.story.lock_for(self.user)
+            ctype, object_id = self.story._lock_key()
+            key = statuses._key(ctype.pk, object_id)
+            generation = statuses.cache._lookup(key)[0]
+            # another process is filling the snapshot
+            fill_key = '%s.%s.fill' % (key, generation)
+            statuses.cache.backend.add(fill_key, True)
+            with self.assertNumQueries(1):
+                self.assertTrue(Story(pk=self.story.pk).lock_info.is_locked)
+            self.assertEquals(statuses.cache.backend.get(key), None)
+            statuses.cache.backend.delete(fill_key)
+            Story(pk=self.story.pk).lock_info
+            self.assertEquals(statuses.cache.backend.get(key),
+                              (generation, Story(pk=self.story.pk).lock_info))
+            self.assertEquals(statuses.cache.backend.get(key)[1].username, self.user.username)
+        finally:
+            for key in ('status_cache', 'status_cache_wait'):
+                del settings.LOCKING[key]
+
+    def test_history(self):
+        with override_settings(LOCKING=dict(settings.LOCKING, history=True)):
+            token = self.story.lock_for(self.user)
+            self.assertRaises(models.ObjectLockedError, self.story.lock_for, self.alt_user)
+            self.story.refresh_lock(token)
+            Story.objects.get(pk=self.story.pk).refresh_lock(token)
+            self.story.unlock_for(self.user, token)
+            # Events are buffered until the end of the request
+            self.assertEquals(models.LockEvent.objects.count(), 0)
+            history.events.flush()
+        events = models.LockEvent.objects.order_by('id')
+        self.assertEquals([e.action for e in events],
+                          ['lock', 'conflict', 'refresh', 'refresh', 'unlock'])
+        self.assertEquals([e.user_id for e in events],
+                          [self.user.pk, self.alt_user.pk, self.user.pk, self.user.pk, self.user.pk])
+        contended = list(models.LockEvent.objects.most_contended())
+        self.assertEquals(contended[0]['object_id'], str(self.story.pk))
+        self.assertEquals(contended[0]['conflicts'], 1)
+        self.assertTrue(Story in models.LockEvent.objects.average_hold_time())
+
+    def test_filter_by_lock(self):
+        self.story.lock_for(self.user)
+        self.alt_story.lock_for(self.alt_user)
+        self.alt_story.locked_at = datetime.now() - timedelta(seconds=time_until_expiration + 1)
+        self.alt_story.lock.save()
+        stories = Story.objects.all()
+        self.assertEquals(list(queries.filter_by_lock(stories, 'mine', self.user)), [self.story])
+        self.assertEquals(list(queries.filter_by_lock(stories, 'others', self.alt_user)), [self.story])
+        self.assertEquals(list(queries.filter_by_lock(stories, 'free')), [self.alt_story])
+        # locks from before expires_at was introduced
+        models.Lock.objects.update(expires_at=None)
+        self.assertEquals(list(queries.filter_by_lock(stories, 'mine', self.user)), [self.story])
+        self.assertEquals(list(queries.filter_by_lock(stories, 'free')), [self.alt_story])
+        self.assertEquals(list(queries.filter_active_locks(models.Lock.objects.all())),
+                          [models.Lock.objects.get(object_id=str(self.story.pk))])
+
+    def test_with_lock_columns(self):
+        self.story.lock_for(self.user, hard_lock=True)
+        story = queries.with_lock_columns(Story.objects.filter(pk=self.story.pk))[0]
+        self.assertEquals(queries.lock_info(story), self.story.lock_info)
+        alt_story = queries.with_lock_columns(Story.objects.filter(pk=self.alt_story.pk))[0]
+        self.assertFalse(queries.lock_info(alt_story).is_locked)
+
+    def test_gather_lockable_models(self):
+        lockable_models = gather_lockable_models()
+        self.assertTrue(Story in lockable_models)
+        self.assertFalse(Unlockable in lockable_models)
+
+    def test_lock_admin_queryset(self):
+        self.story.lock_for(self.user)
+        self.alt_story.lock_for(self.alt_user)
+        lock_admin = LockAdmin(models.Lock, admin.site)
+        with self.assertNumQueries(2):
+            locks = list(lock_admin.queryset(None))
+            self.assertEquals(set(lock.content_object for lock in locks),
+                              set([self.story, self.alt_story]))
+            self.assertEquals(set(lock.locked_by for lock in locks),
+                              set([self.user, self.alt_user]))
+
+    def test_scoped_lock(self):
+        paragraph = Paragraph.objects.create(story=self.story, content="First paragraph.")
+        self.story.lock_for(self.alt_user, hard_lock=True)
+        with self.assertNumQueries(1):
+            self.assertRaises(models.ObjectLockedError, paragraph.save)
+        self.assertTrue(paragraph.lock_applies_to(self.user))
+        self.assertEquals(models.Lock.objects.count(), 1)
+        # new paragraphs are covered by the story's lock as well
+        paragraph = Paragraph(story=self.story, content="Second paragraph.")
+        self.assertRaises(models.ObjectLockedError, paragraph.save)
+        self.assertEquals(self.story.paragraphs.count(), 1)
+
+    def test_scoped_lock_for(self):
+        paragraph = Paragraph.objects.create(story=self.story)
+        token = paragraph.lock_for(self.user)
+        story = Story.objects.get(pk=self.story.pk)
+        self.assertTrue(story.is_locked_by(self.user))
+        self.assertEquals(story.lock.token, token)
+        self.assertEquals(list(queries.filter_by_lock(Paragraph.objects.all(), 'mine', self.user)),
+                          [paragraph])
+        paragraph.unlock_for(self.user, token)
+        self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+
+    def test_field_group_lock_race(self):
+        article = Article.objects.create(title="Title", content="Body")
+        # somebody else locks the group after it was read
+        article.field_group_locks = lambda: {}
+        Article.objects.get(pk=article.pk).lock_field_group_for(self.alt_user, 'body')
+        self.assertRaises(models.ObjectLockedError, article.lock_field_group_for, self.user, 'body')
+        models.Lock.objects.update(expires_at=datetime.now() - timedelta(seconds=1))
+        article.lock_field_group_for(self.user, 'body')
+        self.assertEquals(models.Lock.objects.get(field_group='body').locked_by, self.user)
+
+    def test_field_group_locks(self):
+        article = Article.objects.create(title="Title", content="Body")
+        article.lock_field_group_for(self.alt_user, 'body')
+        article.lock_field_group_for(self.user, 'metadata')
+        self.assertRaises(models.ObjectLockedError, article.lock_field_group_for, self.user, 'body')
+        self.assertRaises(models.ObjectLockedError, article.lock_for, self.user)
+        with self.assertNumQueries(1):
+            locks = article.field_group_locks()
+        self.assertEquals(sorted(locks.keys()), ['body', 'metadata'])
+        self.assertTrue(locks['body'].lock_applies_to(self.user))
+        self.assertFalse(article.is_locked)
+        article.unlock_field_groups_for(self.alt_user)
+        self.assertEquals(article.field_group_locks().keys(), ['metadata'])
+
+    def test_database_clock(self):
+        settings.LOCKING['use_database_clock'] = True
+        try:
+            self.story.lock_for(self.user)
+            story = Story.objects.get(pk=self.story.pk)
+            self.assertTrue(story.is_locked)
+            self.assertTrue(0 < story.lock_seconds_remaining <= time_until_expiration)
+            self.assertEquals(list(queries.filter_by_lock(Story.objects.all(), 'mine', self.user)),
+                              [self.story])
+            lock = story.lock
+            lock.locked_at = dbclock.now() - timedelta(seconds=time_until_expiration + 1)
+            lock.expires_at = dbclock.now() - timedelta(seconds=1)
+            lock.save()
+            self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+            self.assertEquals(queries.filter_by_lock(Story.objects.all(), 'free').count(), 2)
+            models.Lock.objects.update(expires_at=None, locked_at=dbclock.now())
+            self.assertEquals(list(queries.filter_by_lock(Story.objects.all(), 'mine', self.user)),
+                              [self.story])
+        finally:
+            del settings.LOCKING['use_database_clock']
+
+    def test_database_clock_snapshots(self):
+        settings.LOCKING['use_database_clock'] = True
+        # the web server's clock is an hour ahead of the database's
+        previous = clock.install(clock.ManualClock(datetime.now() + timedelta(hours=1)))
+        try:
+            self.story.lock_for(self.user)
+            story = queries.with_lock_columns(Story.objects.filter(pk=self.story.pk))[0]
+            infos = [queries.lock_info(story), Story.objects.get(pk=self.story.pk).lock_info,
+                     LockInfo.from_queryset(models.Lock.objects.all())[0]]
+            infos.append(pickle.loads(pickle.dumps(infos[0])))
+            for info in infos:
+                self.assertTrue(info.is_locked)
+                self.assertTrue(0 < info.lock_seconds_remaining <= time_until_expiration)
+        finally:
+            clock.install(previous)
+            del settings.LOCKING['use_database_clock']
+
+    def test_lock_view(self):
+        view = LockView.as_view(model=Story)
+        factory = RequestFactory()
+        request = factory.post('/')
+        request.user = self.user
+        response = view(request, pk=self.story.pk)
+        token = simplejson.loads(response.content)['lock_token']
+        self.assertEquals(response['ETag'], '"%s"' % token)
+        self.assertTrue(Story.objects.get(pk=self.story.pk).is_locked_by(self.user))
+
+        request = factory.post('/', HTTP_IF_MATCH='"%s"' % token)
+        request.user = self.user
+        with self.assertNumQueries(1):
+            self.assertEquals(view(request, pk=self.story.pk).status_code, 200)
+        request = factory.post('/', HTTP_IF_MATCH='"stale"')
+        request.user = self.user
+        self.assertEquals(view(request, pk=self.story.pk).status_code, 412)
+        request = factory.post('/')
+        request.user = self.alt_user
+        self.assertEquals(view(request, pk=self.story.pk).status_code, 409)
+
+        request = factory.delete('/', HTTP_IF_MATCH='"%s"' % token)
+        request.user = self.user
+        self.assertEquals(view(request, pk=self.story.pk).status_code, 204)
+        self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+
+        for request in (factory.post('/'), factory.delete('/', HTTP_IF_MATCH='"%s"' % token)):
+            request.user = AnonymousUser()
+            self.assertEquals(view(request, pk=self.story.pk).status_code, 403)
+        self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+
+    def test_lock_required(self):
+        factory = RequestFactory()
+        token = self.story.lock_for(self.user)
+        request = factory.post('/')
+        request.user = self.user
+        self.assertEquals(test_views.story_api(request, pk=self.story.pk).status_code, 428)
+        request = factory.post('/', HTTP_IF_MATCH='"stale"')
+        request.user = self.user
+        self.assertEquals(test_views.story_api(request, pk=self.story.pk).status_code, 412)
+        request = factory.post('/', {'lock_token': token})
+        request.user = AnonymousUser()
+        self.assertEquals(test_views.story_api(request, pk=self.story.pk).status_code, 403)
+        request = factory.post('/', {'lock_token': token})
+        request.user = self.user
+        response = test_views.story_api(request, pk=self.story.pk)
+        self.assertEquals(response.status_code, 204)
+        self.assertEquals(response['ETag'], '"%s"' % token)
+
+    def test_lock_mixin(self):
+        view = test_views.StoryUpdateView.as_view()
+        factory = RequestFactory()
+        request = factory.get('/')
+        request.user = self.user
+        response = view(request, pk=self.story.pk)
+        token = response.context_data['lock_token']
+        self.assertTrue(token)
+        self.assertEquals(response['ETag'], '"%s"' % token)
+
+        request = factory.get('/')
+        request.user = self.alt_user
+        response = view(request, pk=self.story.pk)
+        self.assertEquals(response.context_data['lock_token'], None)
+        request = factory.post('/', {'content': 'Overwritten'})
+        request.user = self.alt_user
+        self.assertEquals(view(request, pk=self.story.pk).status_code, 409)
+
+        request = factory.post('/', {'content': 'Edited', 'lock_token': token})
+        request.user = self.user
+        self.assertEquals(view(request, pk=self.story.pk).status_code, 302)
+        story = Story.objects.get(pk=self.story.pk)
+        self.assertEquals(story.content, 'Edited')
+        self.assertFalse(story.is_locked)
+
+        # a form posted after its lock expired and somebody else edited the
+        # story isn't saved, even though nobody holds a lock anymore
+        request = factory.get('/')
+        request.user = self.user
+        token = view(request, pk=self.story.pk).context_data['lock_token']
+        models.Lock.objects.filter(token=token).update(
+            expires_at=datetime.now() - timedelta(seconds=1))
+        request = factory.get('/')
+        request.user = self.alt_user
+        alt_token = view(request, pk=self.story.pk).context_data['lock_token']
+        request = factory.post('/', {'content': 'Other edit', 'lock_token': alt_token})
+        request.user = self.alt_user
+        self.assertEquals(view(request, pk=self.story.pk).status_code, 302)
+        request = factory.post('/', {'content': 'Stale', 'lock_token': token})
+        request.user = self.user
+        self.assertEquals(view(request, pk=self.story.pk).status_code, 409)
+        story = Story.objects.get(pk=self.story.pk)
+        self.assertEquals(story.content, 'Other edit')
+        self.assertFalse(story.is_locked)
+
+        request = factory.get('/')
+        request.user = AnonymousUser()
+        self.assertEquals(view(request, pk=self.story.pk).status_code, 403)
+
+    def test_row_lock(self):
+        note = Note.objects.create(content="A note")
+        token = note.lock_for(self.user)
+        self.assertEquals(models.Lock.objects.count(), 0)
+        note = Note.objects.get(pk=note.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(note.is_locked)
+            self.assertEquals(note.lock.token, token)
+        self.assertTrue(note.lock_applies_to(self.alt_user))
+        self.assertRaises(models.ObjectLockedError, note.lock_for, self.alt_user)
+        with self.assertNumQueries(1):
+            self.assertTrue(note.refresh_lock(token))
+        self.assertEquals(note.lock_info.username, self.user.username)
+
+        # a lock taken since the object was loaded is neither overwritten
+        # by lock_for nor by save
+        stale = Note.objects.get(pk=note.pk)
+        note.unlock_for(self.user, token=token)
+        self.assertFalse(note.is_locked)
+        note.lock_for(self.alt_user)
+        self.assertRaises(models.ObjectLockedError, stale.lock_for, self.user)
+        stale.content = "Edited"
+        stale.save()
+        self.assertTrue(Note.objects.get(pk=note.pk).is_locked_by(self.alt_user))
+
+    def test_row_lock_token_paths(self):
+        note = Note.objects.create(content="A note")
+        token = note.lock_for(self.user)
+        # the lock columns come with the row, the lock itself isn't loaded
+        note = Note.objects.get(pk=note.pk)
+        note.unlock_for(self.user, token=token)
+        self.assertFalse(note.is_locked)
+
+        token = note.lock_for(self.user)
+        loaded = Note.objects.get(pk=note.pk)
+        expires_at = loaded.locking_expires_at
+        self.assertTrue(loaded.refresh_lock(token, expires_in=60))
+        self.assertTrue(loaded.lock.expires_at > expires_at)
+
+        with override_settings(LOCKING=dict(settings.LOCKING, history=True)):
+            loaded.unlock()
+            history.events.flush()
+        event = models.LockEvent.objects.get(action='unlock')
+        self.assertEquals(event.user_id, self.user.pk)
+        self.assertEquals(event.token, token)
+
+    def test_filter_by_row_lock(self):
+        mine = Note.objects.create()
+        others = Note.objects.create()
+        free = Note.objects.create()
+        mine.lock_for(self.user)
+        others.lock_for(self.alt_user)
+        notes = Note.objects.all()
+        self.assertEquals(list(queries.filter_by_lock(notes, 'mine', self.user)), [mine])
+        self.assertEquals(list(queries.filter_by_lock(notes, 'others', self.user)), [others])
+        self.assertEquals(list(queries.filter_by_lock(notes, 'free')), [free])
+        Note.objects.filter(pk=mine.pk).update(locking_expires_at=None)
+        self.assertEquals(list(queries.filter_by_lock(notes, 'mine', self.user)), [mine])
+        self.assertEquals(list(queries.filter_by_lock(notes, 'free')), [free])
+        rows = dict((note.pk, queries.lock_info(note)) for note in queries.with_lock_columns(notes))
+        self.assertEquals(rows[others.pk].username, self.alt_user.username)
+        self.assertFalse(rows[free.pk].is_locked)
+
+    def test_edit_session(self):
+        note = Note.objects.create()
+        session = EditSession(self.user)
+        session.acquire([self.story, note, self.alt_story])
+        for obj in (self.story, self.alt_story, note):
+            obj = obj.__class__.objects.get(pk=obj.pk)
+            self.assertTrue(obj.is_locked_by(self.user))
+            self.assertEquals(obj.lock.token, session.session_id)
+        self.assertEquals(EditSession(self.user, session.session_id).refresh(), 3)
+        self.assertEquals(EditSession(self.alt_user, session.session_id).refresh(), 0)
+        # expired locks aren't extended
+        models.Lock.objects.filter(object_id=str(self.alt_story.pk)) \
+            .update(expires_at=datetime.now() - timedelta(seconds=1))
+        Note.objects.filter(pk=note.pk).update(locking_expires_at=datetime.now() - timedelta(seconds=1))
+        self.assertEquals(session.refresh(), 1)
+        self.assertFalse(Story.objects.get(pk=self.alt_story.pk).is_locked)
+        self.assertFalse(Note.objects.get(pk=note.pk).is_locked)
+        session.release()
+        self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+        self.assertFalse(Note.objects.get(pk=note.pk).is_locked)
+        self.assertEquals(session.refresh(), 0)
+
+    def test_edit_session_all_or_nothing(self):
+        self.alt_story.lock_for(self.alt_user)
+        session = EditSession(self.user)
+        self.assertRaises(models.ObjectLockedError, session.acquire, [self.story, self.alt_story])
+        self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+        self.assertTrue(Story.objects.get(pk=self.alt_story.pk).is_locked_by(self.alt_user))
+
+    def test_edit_session_keeps_previous_locks(self):
+        token = self.story.lock_for(self.user)
+        # locked after self.story, in the session's order
+        blocked = Story.objects.create(content="Locked by somebody else.")
+        blocked.lock_for(self.alt_user)
+        session = EditSession(self.user)
+        self.assertRaises(models.ObjectLockedError, session.acquire,
+                          [Story.objects.get(pk=self.story.pk), blocked])
+        story = Story.objects.get(pk=self.story.pk)
+        self.assertTrue(story.is_locked_by(self.user))
+        self.assertEquals(story.lock.token, token)
+        self.assertTrue(story.refresh_lock(token))
+
+    def test_circuit_breaker_savepoint(self):
+        def fail():
+            connection.cursor().execute("SELECT * FROM locking_no_such_table")
+        settings.LOCKING['budget'] = 10
+        try:
+            # tests run in a transaction, like requests in TransactionMiddleware
+            self.assertTrue(transaction.is_managed())
+            self.assertRaises(breaker.Unavailable, breaker.call, fail)
+            story = Story.objects.get(pk=self.story.pk)
+            self.assertTrue(story.lock_for(self.user))
+            self.assertTrue(Story.objects.get(pk=self.story.pk).is_locked_by(self.user))
+        finally:
+            del settings.LOCKING['budget']
+            breaker.circuit.reset()
+
+    def test_circuit_breaker(self):
+        events = []
+        def receiver(signal, **kwargs):
+            events.append(signal)
+        signals.lock_store_tripped.connect(receiver)
+        signals.lock_store_recovered.connect(receiver)
+        token = self.alt_story.lock_for(self.user)
+        article = Article.objects.create(title="Title", content="Body")
+        # every call is over budget
+        settings.LOCKING.update(budget=-1, breaker_threshold=2, breaker_reset=60)
+        try:
+            Story.objects.get(pk=self.story.pk).is_locked
+            self.assertFalse(breaker.circuit.is_open)
+            Story.objects.get(pk=self.story.pk).is_locked
+            self.assertTrue(breaker.circuit.is_open)
+            self.assertEquals(events, [signals.lock_store_tripped])
+
+            # soft locks fail open, hard locks fail closed
+            story = Story.objects.get(pk=self.story.pk)
+            with self.assertNumQueries(0):
+                self.assertFalse(story.is_locked)
+                self.assertTrue(story.lock_for(self.user))
+            self.assertRaises(models.ObjectLockedError, story.lock_for, self.user, hard_lock=True)
+            story.unlock_for(self.user)
+            # somebody may hold a hard lock, so nothing can be saved
+            self.assertRaises(models.ObjectLockedError, story.save)
+            story._request_user = self.user
+            form = test_forms.StoryAdminForm({'content': 'Edited', 'lock_token': token},
+                                             instance=story)
+            self.assertFalse(form.is_valid())
+            self.assertEquals(form._locking_error_when_saving, 'lock_store_unavailable')
+            alt_story = Story.objects.get(pk=self.alt_story.pk)
+            with self.assertNumQueries(0):
+                self.assertFalse(alt_story.refresh_lock(token))
+                self.assertEquals(article.field_group_locks(), {})
+            Story.lock_fail_open = False
+            Article.lock_fail_open = False
+            try:
+                story = Story.objects.get(pk=self.story.pk)
+                self.assertTrue(story.lock_applies_to(self.user))
+                self.assertRaises(models.ObjectLockedError, story.save)
+                self.assertTrue(article.field_group_locks()[''].lock_applies_to(self.user))
+            finally:
+                del Story.lock_fail_open
+                del Article.lock_fail_open
+
+            settings.LOCKING.update(budget=10, breaker_reset=0)
+            self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+            self.assertFalse(breaker.circuit.is_open)
+            self.assertEquals(events, [signals.lock_store_tripped, signals.lock_store_recovered])
+        finally:
+            for key in ('budget', 'breaker_threshold', 'breaker_reset'):
+                del settings.LOCKING[key]
+            breaker.circuit.reset()
+            signals.lock_store_tripped.disconnect(receiver)
+            signals.lock_store_recovered.disconnect(receiver)
+
+    def test_lock_inventory(self):
+        self.story.lock_for(self.user, hard_lock=True)
+        self.alt_story.lock_for(self.alt_user)
+        locks = list(inventory.lock_inventory(chunk_size=1))
+        self.assertEquals([(lock['object_id'], lock['username'], lock['type']) for lock in locks],
+                          [(str(self.story.pk), self.user.username, 'hard'),
+                           (str(self.alt_story.pk), self.alt_user.username, 'soft')])
+        self.assertEquals(locks[0]['model'], 'tests.story')
+        self.assertEquals(locks[0]['state'], 'active')
+        self.assertEquals([lock['object_id'] for lock
+                           in inventory.lock_inventory(user=self.alt_user)], [str(self.alt_story.pk)])
+        models.Lock.objects.filter(object_id=str(self.alt_story.pk)) \
+            .update(expires_at=datetime.now() - timedelta(seconds=1))
+        self.assertEquals([lock['object_id'] for lock
+                           in inventory.lock_inventory('expired')], [str(self.alt_story.pk)])
+        self.assertEquals(len(list(inventory.lock_inventory('all'))), 2)
+        self.assertEquals(list(inventory.lock_inventory(
+            content_type=ContentType.objects.get_for_model(Article))), [])
+        # locks from before expires_at was introduced
+        models.Lock.objects.filter(object_id=str(self.alt_story.pk)) \
+            .update(expires_at=None, locked_at=datetime.now())
+        locks = list(inventory.lock_inventory())
+        self.assertEquals([lock['state'] for lock in locks], ['active', 'active'])
+        self.assertEquals(list(inventory.lock_inventory('expired')), [])
+        models.Lock.objects.filter(object_id=str(self.alt_story.pk)) \
+            .update(locked_at=datetime.now() - timedelta(seconds=time_until_expiration + 1))
+        self.assertEquals([lock['state'] for lock in inventory.lock_inventory('expired')], ['expired'])
+        models.Lock.objects.filter(object_id=str(self.alt_story.pk)).update(locked_at=None)
+        self.assertEquals(len(list(inventory.lock_inventory('expired'))), 1)
+
+        out = StringIO()
+        call_command('locking_inventory', format='csv', model='tests.Story', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEquals(lines[0], ','.join(inventory.FIELDS))
+        self.assertEquals(len(lines), 2)
+        self.assertTrue(lines[1].startswith('tests.story,%s,,%d,Stan,' % (self.story.pk, self.user.pk)))
+
+    def test_lock_router(self):
+        lock_router = routers.LockRouter()
+        settings.LOCKING['database'] = 'locking'
+        try:
+            self.assertEquals(lock_router.db_for_write(models.Lock), 'locking')
+            self.assertEquals(lock_router.db_for_read(models.Lock), 'locking')
+            self.assertEquals(lock_router.db_for_write(Story), None)
+            self.assertTrue(lock_router.allow_relation(models.Lock(), self.user))
+            self.assertEquals(lock_router.allow_relation(self.story, self.user), None)
+            self.assertFalse(lock_router.allow_syncdb('locking', Story))
+            self.assertEquals(lock_router.allow_syncdb('default', models.Lock), None)
+        finally:
+            del settings.LOCKING['database']
+
+        # locks may point to users and content types of another alias
+        router.routers.insert(0, lock_router)
+        settings.LOCKING['database'] = 'default'
+        try:
+            token = self.story.lock_for(self.user)
+            self.assertTrue(Story.objects.get(pk=self.story.pk).is_locked_by(self.user))
+            self.story.unlock_for(self.user, token=token)
+            self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+        finally:
+            del settings.LOCKING['database']
+            router.routers.remove(lock_router)
+
+    def test_loadtest_percentile(self):
+        from locking.tests.loadtest import percentile
+        values = range(1, 11)
+        self.assertEquals(percentile(values, 50), 5)
+        self.assertEquals(percentile(values, 95), 10)
+        self.assertEquals(percentile(values, 0), 1)
+        self.assertEquals(percentile([3], 99), 3)
+        self.assertEquals(percentile([], 50), 0)
+
+    def test_loadtest_lock_database(self):
+        # locks routed to an alias that wouldn't use the test database
+        from django.core.management.base import CommandError
+        from locking.management.commands.locking_loadtest import Command
+        with override_settings(LOCKING=dict(settings.LOCKING, database='elsewhere')):
+            self.assertRaises(CommandError, Command().handle)
+
     def test_lock_applies_to(self):
         self.story.lock_for(self.alt_user)
         applies = self.story.lock_applies_to(self.user)
@@ -131,6 +895,45 @@ class AppTestCase(BaseTestCase):
 
 
 
+def _has_lock_database():
+    return 'locking' in settings.DATABASES and connections['locking'].vendor != 'sqlite'
+
+
+@unittest.skipUnless(_has_lock_database(), "needs a `locking` alias mirroring the default "
+                     "database, on a database with row-level locking")
+class LockDatabaseTestCase(TransactionTestCase):
+    # Locks on the ``locking`` alias of the test settings, a TEST_MIRROR of
+    # the default database, see ``locking.routers``
+    def setUp(self):
+        self.story = Story.objects.create(content="A story")
+        self.user = User.objects.create_user("Stan", "stan@example.com", "secret")
+        self.lock_router = routers.LockRouter()
+        router.routers.insert(0, self.lock_router)
+        settings.LOCKING['database'] = 'locking'
+
+    def tearDown(self):
+        del settings.LOCKING['database']
+        router.routers.remove(self.lock_router)
+        models.Lock.objects.all().delete()
+
+    def test_lock_survives_rollback(self):
+        @transaction.commit_on_success
+        def edit():
+            self.story.lock_for(self.user)
+            raise ValueError
+        self.assertRaises(ValueError, edit)
+        self.assertTrue(Story.objects.get(pk=self.story.pk).is_locked_by(self.user))
+
+    def test_lock_cost_middleware(self):
+        middleware = LockCostMiddleware()
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        self.story.lock_for(self.user)
+        response = middleware.process_response(request, HttpResponse())
+        self.assertFalse(', 0 queries' in response['Server-Timing'])
+        self.assertFalse(connection.use_debug_cursor)
+
+
 class BrowserTestCase(BaseTestCase):
     apps = ('locking.tests', 'django.contrib.auth', 'django.contrib.admin', )
     users = [
@@ -168,6 +971,19 @@ class BrowserTestCase(BaseTestCase):
         self.assertEquals(response.status_code, 200)
         self.assertTrue(self.story.is_locked)
 
+    def test_lock_when_lazy(self):
+        settings.LOCKING['lazy_acquire'] = True
+        try:
+            response = self.client.get(self.urls['change'])
+        finally:
+            del settings.LOCKING['lazy_acquire']
+        self.assertEquals(response.status_code, 200)
+        self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+        # The lock is taken once the user starts editing
+        response = self.client.get(reverse('admin:refresh_lock_tests_story', args=[self.story.pk]))
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(Story.objects.get(pk=self.story.pk).is_locked)
+
     def test_lock_when_logged_out(self):
         self.client.logout()
         self.client.get(self.urls['change'])  # redirect to login page
@@ -191,6 +1007,44 @@ class BrowserTestCase(BaseTestCase):
         self.story.save()
         response = self.client.get(reverse('admin:refresh_lock_tests_story', args=[self.story.pk]))
         self.assertEquals(response.status_code, 409)
+        self.assertEquals(simplejson.loads(response.content)['for_user'], self.alt_user.get_full_name())
+
+    def test_read_only_when_locked(self):
+        self.story.lock_for(self.alt_user)
+        settings.LOCKING['read_only_when_locked'] = True
+        try:
+            # objects are only displayable once loaded, like ones whose
+            # __unicode__ follows a foreign key
+            Story.__unicode__ = lambda story: story.content or Story.objects.get(pk=0).content
+            try:
+                response = self.client.get(self.urls['change'])
+            finally:
+                del Story.__unicode__
+            self.assertContains(response, self.story.content)
+            self.assertNotContains(response, 'name="content"')
+            self.assertEquals(response.context['adminform'].readonly_fields, ['content'])
+            # the tag takes whether the lock applies from the change view,
+            # rather than checking again
+            request = RequestFactory().get('/')
+            request._locking_applies = False
+            context = {'change': True, 'original': self.story, 'request': request,
+                       'adminform': response.context['adminform']}
+            infos = simplejson.loads(locking_tags.locking_variables(context)['locking_infos'])
+            self.assertFalse(infos['applies'])
+            self.assertTrue(Story.objects.get(pk=self.story.pk).is_locked_by(self.alt_user))
+            # the admin's option wins over the setting
+            admin.site._registry[Story].read_only_when_locked = False
+            try:
+                response = self.client.get(self.urls['change'])
+            finally:
+                admin.site._registry[Story].read_only_when_locked = None
+            self.assertContains(response, 'name="content"')
+            # editable as usual when the lock doesn't apply
+            self.story.unlock()
+            response = self.client.get(self.urls['change'])
+            self.assertContains(response, 'name="content"')
+        finally:
+            del settings.LOCKING['read_only_when_locked']
 
     def test_unlock_when_allowed(self):
         self.story.lock_for(self.user)
@@ -213,15 +1067,101 @@ class BrowserTestCase(BaseTestCase):
         data = simplejson.loads(response.content)
         self.assertTrue('original_locked_at' in data.keys())
         self.assertTrue('original_modified_at' in data.keys())
+        self.assertEquals(data['lock_token'], Story.objects.get(pk=self.story.pk).lock.token)
+
+    def test_refresh_lock_with_token(self):
+        token = self.story.lock_for(self.user)
+        response = self.client.get(reverse('admin:refresh_lock_tests_story', args=[self.story.pk]),
+                                   {'token': token})
+        self.assertEquals(simplejson.loads(response.content)['lock_token'], token)
+
+    def test_save_with_token(self):
+        self.client.get(self.urls['change'])
+        token = Story.objects.get(pk=self.story.pk).lock.token
+        response = self.client.post(self.urls['change'], {'content': 'Edited', 'lock_token': token})
+        self.assertEquals(response.status_code, 302)
+        self.assertFalse(Story.objects.get(pk=self.story.pk).is_locked)
+
+    def test_save_with_token_from_other_window(self):
+        self.client.get(self.urls['change'])
+        token = Story.objects.get(pk=self.story.pk).lock.token
+        Story.objects.get(pk=self.story.pk).lock_for(self.user)
+        response = self.client.post(self.urls['change'], {'content': 'Edited', 'lock_token': token})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.context['adminform'].form._locking_error_when_saving, 'was_already_locked')
+
+    def test_save_field_group(self):
+        article = Article.objects.create(title="Title", content="Body")
+        article.lock_field_group_for(self.alt_user, 'body')
+        url = reverse('admin:tests_article_change', args=[article.pk])
+        response = self.client.get(url)
+        self.assertTrue(article.field_group_locks()['metadata'].is_locked_by(self.user))
+        self.assertEquals(response.context['adminform'].readonly_fields, ['content'])
+        # the browser doesn't post the fields of the group somebody else
+        # holds, which saves them in the meantime
+        Article.objects.filter(pk=article.pk).update(content='Their body')
+        response = self.client.post(url, {'title': 'New title'})
+        self.assertEquals(response.status_code, 302)
+        article = Article.objects.get(pk=article.pk)
+        self.assertEquals((article.title, article.content), ('New title', 'Their body'))
+        self.assertFalse('metadata' in article.field_group_locks())
+        # nor are they saved when they're posted
+        response = self.client.post(url, {'title': 'New title', 'content': 'New body'})
+        self.assertEquals(response.status_code, 302)
+        self.assertEquals(Article.objects.get(pk=article.pk).content, 'Their body')
+
+    def test_refresh_field_group_lock(self):
+        article = Article.objects.create(title="Title", content="Body")
+        article.lock_field_group_for(self.alt_user, 'body')
+        url = reverse('admin:refresh_lock_tests_article', args=[article.pk])
+        self.assertEquals(self.client.get(url, {'field_group': 'body'}).status_code, 409)
+        self.assertEquals(self.client.get(url, {'field_group': 'metadata'}).status_code, 200)
+        # a heartbeat for the whole object doesn't conflict with the groups
+        # of others, and doesn't lock it
+        response = self.client.get(url, {'token': 'stale'})
+        self.assertEquals(response.status_code, 200)
+        data = simplejson.loads(response.content)
+        self.assertEquals(data['lock_token'], '')
+        self.assertEquals(data['locked_field_groups'], ['body'])
+        self.assertFalse('' in article.field_group_locks())
+
+    def test_unlock_with_stale_token(self):
+        token = self.story.lock_for(self.user)
+        self.story.lock_for(self.user)
+        response = self.client.get(reverse('admin:unlock_tests_story', args=[self.story.pk]),
+                                   {'token': token})
+        self.assertEquals(response.status_code, 403)
+        self.assertTrue(Story.objects.get(pk=self.story.pk).is_locked)
 
     def test_js_variables_tag(self):
         rendered = Template("{% load locking_tags %}{% locking_variables %}").render(RequestContext(None))
         self.assertTrue('"time_until_warning": %d' % settings.LOCKING['time_until_warning'] in rendered)
         self.assertTrue('"time_until_expiration": %d' % settings.LOCKING['time_until_expiration'] in rendered)
 
+    def test_lock_cost_middleware(self):
+        middleware = settings.MIDDLEWARE_CLASSES + ('locking.middleware.LockCostMiddleware',)
+        with override_settings(MIDDLEWARE_CLASSES=middleware):
+            response = self.client.get(self.urls['change'])
+        timing = response['Server-Timing']
+        self.assertTrue('locking.lock_read;dur=' in timing)
+        self.assertTrue('locking.lock_write;dur=' in timing)
+        self.assertTrue('locking.contenttype;dur=' in timing)
+
     def test_admin_media(self):
         response = self.client.get(self.urls['change'])
-        self.assertContains(response, 'admin.locking.js')
+        self.assertContains(response, assets.bundle_url())
+        self.assertNotContains(response, 'admin.locking.js')
+
+    def test_bundle(self):
+        url = assets.bundle_url('nl')
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('max-age=31536000' in response['Cache-Control'])
+        self.assertTrue('locking.admin = function' in response.content)
+        self.assertFalse('Begin wrap' in response.content)
+        stale = reverse('locking_bundle', kwargs={'language': 'nl', 'digest': '0'})
+        self.assertRedirects(self.client.get(stale), url)
+        self.assertRaises(Http404, views.bundle, None, 'xx', '0')
 
     def test_admin_changelist_when_locked(self):
         self.story.lock_for(self.alt_user)
@@ -234,6 +1174,55 @@ class BrowserTestCase(BaseTestCase):
         response = self.client.get(self.urls['changelist'])
         self.assertContains(response, 'locking/img/page_edit.png')
 
+    def test_admin_changelist_lock_filter(self):
+        self.story.lock_for(self.alt_user)
+        response = self.client.get(self.urls['changelist'], {'lock': 'others'})
+        self.assertEquals(list(response.context['cl'].result_list), [self.story])
+        response = self.client.get(self.urls['changelist'], {'lock': 'free'})
+        self.assertEquals(list(response.context['cl'].result_list), [self.alt_story])
+
+    def test_admin_changelist_sort_by_lock(self):
+        # every story is locked, databases sort stories without a lock
+        # (NULL) first or last
+        self.story.lock_for(self.alt_user)
+        self.alt_story.lock_for(self.alt_user)
+        models.Lock.objects.filter(object_id=str(self.story.pk)) \
+            .update(locked_at=datetime.now() - timedelta(seconds=5))
+        response = self.client.get(self.urls['changelist'], {'o': '-1'})
+        self.assertEquals(list(response.context['cl'].result_list), [self.alt_story, self.story])
+        response = self.client.get(self.urls['changelist'], {'o': '1'})
+        self.assertEquals(list(response.context['cl'].result_list), [self.story, self.alt_story])
+
+    def test_admin_lock_changelist(self):
+        self.story.lock_for(self.alt_user)
+        response = self.client.get(reverse('admin:locking_lock_changelist'),
+                                   {'locked_by': self.alt_user.pk})
+        self.assertContains(response, self.urls['change'])
+        # only users holding locks can be filtered on
+        holders = [spec for spec in response.context['cl'].filter_specs
+                   if spec.parameter_name == 'locked_by'][0]
+        self.assertEquals(holders.lookup_choices, [(self.alt_user.pk, self.alt_user.username)])
+        lock = models.Lock.objects.get()
+        response = self.client.get(reverse('admin:locking_lock_change', args=[lock.pk]))
+        fields = response.context['adminform'].form.fields
+        self.assertFalse('content_type' in fields or 'object_id' in fields)
+
+    def test_admin_lock_export(self):
+        self.story.lock_for(self.alt_user)
+        self.alt_story.lock_for(self.user)
+        response = self.client.get(reverse('admin:locking_lock_changelist'))
+        self.assertContains(response, 'export/?format=csv')
+        response = self.client.get(reverse('admin:locking_lock_export'),
+                                   {'locked_by': self.alt_user.pk})
+        self.assertEquals(response['Content-Type'], 'application/x-ndjson')
+        locks = [simplejson.loads(line) for line in response.content.splitlines()]
+        self.assertEquals([lock['object_id'] for lock in locks], [str(self.story.pk)])
+        response = self.client.get(reverse('admin:locking_lock_export'), {'state': 'nope'})
+        self.assertEquals(response.status_code, 400)
+        for name in ('model', 'locked_by'):
+            response = self.client.get(reverse('admin:locking_lock_export'), {name: 'nope'})
+            self.assertEquals(response.status_code, 400)
+
     def test_admin_changelist_when_unlocked(self):
         response = self.client.get(self.urls['changelist'])
         self.assertNotContains(response, 'locking/img')
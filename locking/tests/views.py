@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+from django.http import HttpResponse
+from django.views.generic import UpdateView
+
+from locking.views import LockMixin, lock_required
+
+from models import Story
+
+
+class StoryUpdateView(LockMixin, UpdateView):
+    model = Story
+    template_name = 'tests/story_form.html'
+    success_url = '/done/'
+
+
+@lock_required(Story)
+def story_api(request, pk):
+    return HttpResponse(status=204)
@@ -1,5 +1,8 @@
 from django.conf.urls.defaults import *
 
 urlpatterns = patterns('',
+        url(r'^bundle/(?P<language>[\w-]+)\.(?P<digest>[0-9a-f]+)\.js$', 'locking.views.bundle',
+            name='locking_bundle'),
+        # Not used by the admin anymore, which gets its translations from the bundle
         (r'jsi18n/$', 'django.views.i18n.javascript_catalog', {'packages': 'locking'}),
-    )
\ No newline at end of file
+    )
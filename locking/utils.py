@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from django.db.models import get_models
+
+from locking.models import lockable_models
+
+
+def gather_lockable_models():
+    """
+    Returns all models that have ``LockableModelMethodsMixin`` as a base
+    class, in the order in which they were defined.
+    """
+    # Make sure all installed apps have been loaded (and thus registered)
+    get_models()
+    return list(lockable_models)
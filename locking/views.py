@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Locking outside of the admin: the script bundle of ``LockableAdmin``, and
+mixins, views and decorators that give generic class-based views and JSON
+endpoints the lock, heartbeat and unlock semantics of ``LockableAdmin``.
+
+Lock tokens (see ``LockableModelMethodsMixin.lock_for``) double as entity
+tags: responses carry the token of the user's lock in their ``ETag``
+header, and clients send it back in an ``If-Match`` header (or as a
+``lock_token`` parameter) to refresh, use or release that lock. Those paths
+take a single conditional UPDATE, and don't fetch the object itself.
+"""
+from functools import wraps
+
+from django.conf import settings
+from django.core.exceptions import NON_FIELD_ERRORS
+from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.shortcuts import get_object_or_404
+from django.utils import simplejson
+from django.utils.cache import patch_cache_control, patch_response_headers
+from django.utils.html import escape
+from django.utils.translation import ugettext as _
+from django.views.generic import View
+from django.views.generic.detail import SingleObjectMixin
+
+from locking import assets
+from locking.models import ObjectLockedError
+from locking.sessions import EditSession
+
+# Bundle urls change with their content, so they can be cached for a year
+BUNDLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def bundle(request, language, digest):
+    """
+    Serves the script bundle for ``language`` (see ``locking.assets``).
+    Requests for an outdated bundle are redirected to the current one.
+    """
+    languages = dict(settings.LANGUAGES)
+    if language not in languages and language.split('-')[0] not in languages:
+        raise Http404
+    script, current_digest = assets.bundles.get(language)
+    if digest != current_digest:
+        return HttpResponseRedirect(assets.bundle_url(language))
+    response = HttpResponse(script, content_type='text/javascript; charset=utf-8')
+    patch_response_headers(response, BUNDLE_MAX_AGE)
+    patch_cache_control(response, public=True)
+    return response
+
+
+def request_token(request):
+    """
+    Returns the lock token sent with ``request``, from its ``If-Match``
+    header or its ``lock_token`` parameter, or ''.
+    """
+    etag = request.META.get('HTTP_IF_MATCH', '').strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag.strip('"') or request.REQUEST.get('lock_token', '')
+
+
+def _is_anonymous(request):
+    # Locks are held by users, anonymous requests can't take or release one
+    user = getattr(request, 'user', None)
+    return user is None or not user.is_authenticated()
+
+
+def _lock_target(model, pk):
+    # Locks are found from the object's key alone, so unless the lock is the
+    # parent's there's no need to fetch the object
+    if model.lock_parent:
+        return get_object_or_404(model, pk=pk)
+    return model(pk=pk)
+
+
+def _json_response(data, status=200, token=None):
+    response = HttpResponse(simplejson.dumps(data), status=status, mimetype="application/json")
+    if token:
+        response['ETag'] = '"%s"' % token
+    return response
+
+
+def _conflict_response(obj):
+    locked_by = obj.locked_by
+    return _json_response({
+        'for_user': locked_by and escape(locked_by.get_full_name()) or '',
+    }, status=409)  # Conflict
+
+
+def lock_required(model, pk_kwarg='pk'):
+    """
+    Decorator for function views that change an object of ``model``, whose
+    primary key is the ``pk_kwarg`` argument of the view. Unsafe requests
+    (POST, PUT, PATCH and DELETE) must send the token of the user's lock on
+    that object, or get a 428 (no token) or 412 (not the token of the
+    current lock) response. The token is set as ``request.lock_token``.
+
+    The lock is refreshed, not released: release it with ``LockView``, or
+    with ``unlock_for`` in the view.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('POST', 'PUT', 'PATCH', 'DELETE'):
+                return view(request, *args, **kwargs)
+            if _is_anonymous(request):
+                return HttpResponse(status=403)
+            token = request_token(request)
+            if not token:
+                return HttpResponse(status=428)  # Precondition Required
+            if not _lock_target(model, kwargs[pk_kwarg]).refresh_lock(token):
+                return HttpResponse(status=412)  # Precondition Failed
+            request.lock_token = token
+            response = view(request, *args, **kwargs)
+            if response.status_code < 400 and not response.has_header('ETag'):
+                response['ETag'] = '"%s"' % token
+            return response
+        return wrapper
+    return decorator
+
+
+class LockMixin(object):
+    """
+    Locking for generic views on a single lockable object, such as
+    ``UpdateView``, with the semantics of ``LockableAdmin``: displaying the
+    object locks it for the user, and a valid form is only saved if the user
+    still holds that lock, which is released by the save. A form posted with
+    the token of a lock that has expired isn't saved either, since somebody
+    else may have saved the object in the meantime. Anonymous users get a
+    403 response.
+
+    The token of the lock is passed to the template as ``lock_token`` (None
+    if somebody else holds the lock, described by ``lock``) and in the
+    ``ETag`` header. Forms should post it back as ``lock_token``.
+    """
+    lock_token = None
+
+    def dispatch(self, request, *args, **kwargs):
+        if _is_anonymous(request):
+            return HttpResponse(status=403)
+        return super(LockMixin, self).dispatch(request, *args, **kwargs)
+
+    def get_object(self, queryset=None):
+        obj = super(LockMixin, self).get_object(queryset)
+        obj._request_user = self.request.user
+        return obj
+
+    def acquire_lock(self):
+        """
+        Locks ``self.object`` for the user, and returns the lock token or
+        None if it's locked by somebody else.
+        """
+        try:
+            return self.object.lock_for(self.request.user)
+        except ObjectLockedError:
+            return None
+
+    def get_context_data(self, **kwargs):
+        if self.request.method == 'GET':
+            self.lock_token = self.acquire_lock()
+        context = super(LockMixin, self).get_context_data(**kwargs)
+        context.update({
+            'lock_token': self.lock_token,
+            'lock': self.object.lock_info,
+        })
+        return context
+
+    def render_to_response(self, context, **response_kwargs):
+        response = super(LockMixin, self).render_to_response(context, **response_kwargs)
+        if self.lock_token:
+            response['ETag'] = '"%s"' % self.lock_token
+        return response
+
+    def lock_conflict(self, form):
+        """
+        Response to a valid form that can't be saved because the user
+        doesn't hold the lock: the form, with an error, and a 409 status.
+        """
+        form._errors[NON_FIELD_ERRORS] = form.error_class([
+            _("This object is being edited by somebody else, or by you in another window.")])
+        response = super(LockMixin, self).form_invalid(form)
+        response.status_code = 409  # Conflict
+        return response
+
+    def form_invalid(self, form):
+        # Keep the lock that was posted
+        self.lock_token = request_token(self.request)
+        return super(LockMixin, self).form_invalid(form)
+
+    def form_valid(self, form):
+        self.lock_token = request_token(self.request)
+        if not self.object.refresh_lock(self.lock_token):
+            self.lock_token = None
+            return self.lock_conflict(form)
+        # Unlock before saving, like LockableAdmin.save_model
+        self.object.unlock_for(self.request.user, token=self.lock_token)
+        self.lock_token = None
+        return super(LockMixin, self).form_valid(form)
+
+
+class LockView(SingleObjectMixin, View):
+    """
+    JSON endpoint for the lock on an object, for scripts and API clients:
+
+    * ``POST`` without a token locks the object for the user, ``POST`` with
+      the token of the user's lock (the heartbeat) extends it. Both answer
+      with the token, also in the ``ETag`` header, and the number of seconds
+      until the lock expires; 409 if somebody else holds the lock, 412 if
+      the token isn't the one of the current lock.
+    * ``DELETE`` with a token releases the lock (204, or 409).
+    * ``GET`` describes the lock.
+
+    ``POST`` and ``DELETE`` get a 403 response for anonymous users.
+    """
+    def get_object(self, queryset=None):
+        obj = super(LockView, self).get_object(queryset)
+        obj._request_user = self.request.user
+        return obj
+
+    def _lock_target(self):
+        model = self.model or self.get_queryset().model
+        return _lock_target(model, self.kwargs[self.pk_url_kwarg])
+
+    def _lock_response(self, token):
+        return _json_response({
+            'lock_token': token,
+            'expires_in': settings.LOCKING['time_until_expiration'],
+        }, token=token)
+
+    def get(self, request, *args, **kwargs):
+        obj = self.get_object()
+        lock = obj.lock_info
+        return _json_response({
+            'is_locked': lock.is_locked,
+            'locked_by': lock.is_locked and lock.username or None,
+            'hard_lock': lock.hard_lock,
+            'seconds_remaining': lock.is_locked and lock.lock_seconds_remaining or 0,
+        })
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method in ('POST', 'DELETE') and _is_anonymous(request):
+            return HttpResponse(status=403)
+        return super(LockView, self).dispatch(request, *args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        token = request_token(request)
+        if token:
+            if not self._lock_target().refresh_lock(token):
+                return HttpResponse(status=412)  # Precondition Failed
+            return self._lock_response(token)
+        obj = self.get_object()
+        try:
+            token = obj.lock_for(request.user)
+        except ObjectLockedError:
+            return _conflict_response(obj)
+        return self._lock_response(token)
+
+    def delete(self, request, *args, **kwargs):
+        token = request_token(request)
+        if not token:
+            return HttpResponse(status=428)  # Precondition Required
+        try:
+            self._lock_target().unlock_for(request.user, token=token)
+        except ObjectLockedError:
+            return HttpResponse(status=409)  # Conflict
+        return HttpResponse(status=204)
+
+
+class EditSessionView(View):
+    """
+    JSON endpoint for the edit session (see ``locking.sessions``) whose id is
+    sent in the ``If-Match`` header, or as the ``lock_token`` parameter:
+
+    * ``POST`` extends all locks of the session (412 if it has expired or
+      was released).
+    * ``DELETE`` releases them (204).
+    """
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.is_authenticated():
+            return HttpResponse(status=403)
+        session_id = request_token(request)
+        if not session_id:
+            return HttpResponse(status=428)  # Precondition Required
+        self.session = EditSession(request.user, session_id)
+        return super(EditSessionView, self).dispatch(request, *args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        count = self.session.refresh()
+        if not count:
+            return HttpResponse(status=412)  # Precondition Failed
+        return _json_response({
+            'locks': count,
+            'expires_in': settings.LOCKING['time_until_expiration'],
+        }, token=self.session.session_id)
+
+    def delete(self, request, *args, **kwargs):
+        self.session.release()
+        return HttpResponse(status=204)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+In-process bookkeeping of threads waiting for a lock to be released.
+
+Waiters are queued per locked object, so that they get the lock in the order
+in which they asked for it. When a lock is released, the ``lock_released``
+signal wakes up the first waiter in line for that object. Releases happening
+in another process (or locks that simply expire) are caught by polling, see
+``LockableModelMethodsMixin.acquire``.
+
+If you run several processes and want waiters to be woken up right away, you
+can relay ``lock_released`` through the pub/sub of your choice and call
+``waiters.notify`` in each process when a message comes in.
+"""
+from collections import deque
+import threading
+
+from locking import signals
+
+
+class LockWaiters(object):
+    """
+    FIFO queues of waiters, keyed by ``(content_type_id, object_id)``.
+    """
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._queues = {}
+
+    def enqueue(self, key):
+        """
+        Puts a new waiter at the end of the queue for ``key`` and returns it.
+        A waiter is a ``threading.Event`` that gets set when it's its turn.
+        """
+        waiter = threading.Event()
+        self._mutex.acquire()
+        try:
+            queue = self._queues.setdefault(key, deque())
+            queue.append(waiter)
+            if len(queue) == 1:
+                waiter.set()
+        finally:
+            self._mutex.release()
+        return waiter
+
+    def is_first(self, key, waiter):
+        self._mutex.acquire()
+        try:
+            queue = self._queues.get(key)
+            return bool(queue) and queue[0] is waiter
+        finally:
+            self._mutex.release()
+
+    def remove(self, key, waiter):
+        """
+        Removes ``waiter`` from the queue for ``key``, whether it got the lock
+        or gave up, and hands the turn over to the next waiter in line.
+        """
+        self._mutex.acquire()
+        try:
+            queue = self._queues.get(key)
+            if queue is None:
+                return
+            try:
+                queue.remove(waiter)
+            except ValueError:
+                pass
+            if queue:
+                queue[0].set()
+            else:
+                del self._queues[key]
+        finally:
+            self._mutex.release()
+
+    def notify(self, key):
+        """
+        Wakes up the first waiter in line for ``key``, if any.
+        """
+        self._mutex.acquire()
+        try:
+            queue = self._queues.get(key)
+            if queue:
+                queue[0].set()
+        finally:
+            self._mutex.release()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+waiters = LockWaiters()
+
+
+def notify_waiters(sender, content_type_id, object_id, **kwargs):
+    waiters.notify((content_type_id, object_id))
+
+signals.lock_released.connect(notify_waiters,
+                              dispatch_uid='locking.waiters.notify_waiters')